@@ -0,0 +1,56 @@
+"""
+Atomic writes of small state files (json, npz)
+
+A file is written to a temporary file in the same directory and renamed over
+the target, so readers see either the old or the new complete file.
+The directory is created if it does not exist.
+"""
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+@contextmanager
+def replace_file(file_name):
+    """
+    Yields a temporary file name to write to, it replaces file_name when the block succeeds
+    """
+
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+
+    base, ext = os.path.splitext(file_name)
+    file_tmp = "{:s}.{:d}.{:d}.tmp{:s}".format(base, os.getpid(), threading.get_ident(), ext)
+    try:
+        yield file_tmp
+        os.replace(file_tmp, file_name)
+    finally:
+        if os.path.exists(file_tmp):
+            os.remove(file_tmp)
+
+def read_json(file_name):
+    """
+    Returns the json file content, None if there is no file or it cannot be read
+    """
+
+    if not os.path.isfile(file_name):
+        return None
+
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f'Cannot read {file_name}, ignore it')
+        return None
+
+def write_json(file_name, obj, **kwargs):
+
+    with replace_file(file_name) as file_tmp:
+        with open(file_tmp, 'w') as f:
+            json.dump(obj, f, **kwargs)
+
+def write_npz(file_name, **arrays):
+
+    with replace_file(file_name) as file_tmp:
+        np.savez(file_tmp, **arrays)
@@ -0,0 +1,135 @@
+"""
+T0-aligned Swift-BAT lightcurves of many bursts in one array
+
+The lightcurves are put onto a common T-T0 grid in a contiguous float32
+matrix (one row per burst, NaN where there is no data), burst parameters
+are in a side table. Superposed epoch sums and medians are then single
+numpy operations over the burst axis.
+"""
+import traceback
+
+import numpy as np
+
+from astropy.table import Table
+from astropy.io import ascii
+
+import atomic_file
+from swift_bat_rate_lc import dic_res_bin
+from get_swift_bat_rate import load_lc, date_time_sod_to_iso, get_ipn_name
+
+import config
+
+conf = config.read_config('config.yaml')
+
+class bat_cohort:
+
+    def __init__(self, arr_t, arr_counts, tab_meta):
+        """
+        arr_t: bin starts T-T0 (s), arr_counts: (n_bursts, n_bins) float32, tab_meta: one row per burst
+        """
+
+        self.arr_t = arr_t
+        self.arr_counts = arr_counts
+        self.tab_meta = tab_meta
+
+    def __len__(self):
+        return self.arr_counts.shape[0]
+
+    def get_mask(self):
+        """
+        True where the burst has no data
+        """
+        return np.isnan(self.arr_counts)
+
+    def get_counts(self, subtract_bg=False):
+
+        if subtract_bg:
+            return self.arr_counts - np.asarray(self.tab_meta['Bg'], dtype=np.float32)[:,None]
+        return self.arr_counts
+
+    def superposed_sum(self, subtract_bg=False):
+        return np.nansum(self.get_counts(subtract_bg), axis=0)
+
+    def superposed_mean(self, subtract_bg=False):
+        return np.nanmean(self.get_counts(subtract_bg), axis=0)
+
+    def superposed_median(self, subtract_bg=False):
+        return np.nanmedian(self.get_counts(subtract_bg), axis=0)
+
+    def get_coverage(self):
+        """
+        Number of bursts with data in each bin
+        """
+        return np.count_nonzero(~self.get_mask(), axis=0)
+
+    def write(self, file_prefix):
+        """
+        Save arrays to <file_prefix>.npz and the burst table to <file_prefix>_meta.ecsv
+        """
+
+        atomic_file.write_npz(file_prefix + '.npz', arr_t=self.arr_t, arr_counts=self.arr_counts)
+        self.tab_meta.write(file_prefix + '_meta.ecsv', overwrite=True, format='ascii.ecsv')
+
+    @classmethod
+    def read(cls, file_prefix):
+
+        data = np.load(file_prefix + '.npz')
+        tab_meta = ascii.read(file_prefix + '_meta.ecsv', format='ecsv')
+        return cls(data['arr_t'], data['arr_counts'], tab_meta)
+
+def load_cohort(lst_date_time, t_begin=-100.0, t_end=300.0, res='ms', factor=1, t_bg_end=-20.0, path_to_down=None):
+    """
+    Load lightcurves for burst list entries ('YYYYMMDD SSSSS.sss') onto the common grid
+    from t_begin to t_end (s from T0) with bins of factor native bins.
+    Background is the mean counts per bin before t_bg_end.
+    A burst which fails to load is kept as a row of NaN with the error in the table.
+    """
+
+    if path_to_down is None:
+        path_to_down = conf['download_path']
+
+    bin_size = dic_res_bin[res] * factor
+    n_bins = int(np.floor((t_end - t_begin) / bin_size))
+    arr_t = t_begin + bin_size * np.arange(n_bins)
+
+    n = len(lst_date_time)
+    arr_counts = np.full((n, n_bins), np.nan, dtype=np.float32)
+
+    lst_name, lst_obsid, lst_err = [], [], []
+    arr_bg = np.full(n, np.nan)
+
+    window = (t_begin - bin_size, t_end + bin_size)
+
+    for i, date_time in enumerate(lst_date_time):
+
+        date, sod = date_time.split()
+        lst_name.append(get_ipn_name(date, float(sod)))
+        obsid, err = '', ''
+
+        try:
+            lc, obsid = load_lc(date_time_sod_to_iso(date_time), path_to_down, res, window)
+            if lc is None:
+                err = 'No data'
+            else:
+                t, counts = lc.get_lc(factor)
+                idx = np.rint((t - t_begin) / bin_size).astype(np.int64)
+                arr_good = (idx >= 0) & (idx < n_bins)
+                arr_counts[i, idx[arr_good]] = counts[arr_good]
+        except Exception as e:
+            traceback.print_exc()
+            err = "{:s}: {:s}".format(type(e).__name__, str(e))
+
+        lst_obsid.append(obsid if obsid is not None else '')
+        lst_err.append(err)
+
+    arr_n_bins = np.count_nonzero(~np.isnan(arr_counts), axis=1).astype(np.int32)
+
+    arr_bg_bins = arr_counts[:, arr_t <= t_bg_end]
+    arr_has_bg = np.any(~np.isnan(arr_bg_bins), axis=1)
+    arr_bg[arr_has_bg] = np.nanmean(arr_bg_bins[arr_has_bg], axis=1)
+
+    tab_meta = Table([lst_date_time, lst_name, lst_obsid, arr_bg, arr_n_bins, lst_err],
+        names=['DateTime', 'Name', 'ObsID', 'Bg', 'NBins', 'Error'])
+    tab_meta['Bg'].format = '%.3f'
+
+    return bat_cohort(arr_t, arr_counts, tab_meta)
@@ -0,0 +1,153 @@
+"""
+Swift-BAT coded fraction response grid in the instrument frame
+
+Coded fraction depends only on the source position in the BAT frame, i.e. on
+the point (tan(theta) |cos(phi)|, tan(theta) sin(phi)) of the tangent plane.
+The grid of it is built once with the swiftbat mask geometry (get_coded_fov.bat_area),
+refined until the bilinear interpolation error is below the requested bound
+and kept in a npz file. A pointing then needs only the rotation to the BAT frame
+(get_coded_fov.bat_theta_phi) and the interpolation.
+"""
+import os
+
+import numpy as np
+
+import atomic_file
+import config
+
+conf = config.read_config('config.yaml')
+
+_grid = None
+
+class response_grid:
+
+    def __init__(self, arr_x, arr_y, arr_frac, max_err):
+        """
+        arr_x, arr_y: grid nodes in the tangent plane, arr_frac: coded fraction (len(arr_x), len(arr_y)),
+        max_err: interpolation error of the grid measured by make_grid
+        """
+
+        self.arr_x = arr_x
+        self.arr_y = arr_y
+        self.arr_frac = arr_frac
+        self.max_err = max_err
+
+        self._x0, self._dx = arr_x[0], arr_x[1] - arr_x[0]
+        self._y0, self._dy = arr_y[0], arr_y[1] - arr_y[0]
+
+    def interp(self, x, y):
+        """
+        Coded fraction in the tangent plane points x, y, 0 outside the grid
+        """
+
+        nx, ny = self.arr_x.size, self.arr_y.size
+        u = (np.asarray(x, dtype=float) - self._x0) / self._dx
+        v = (np.asarray(y, dtype=float) - self._y0) / self._dy
+
+        arr_in = (u >= 0) & (u <= nx - 1) & (v >= 0) & (v <= ny - 1)
+        u = np.where(arr_in, u, 0.0)
+        v = np.where(arr_in, v, 0.0)
+
+        i = np.minimum(u.astype(np.int64), nx - 2)
+        j = np.minimum(v.astype(np.int64), ny - 2)
+        du, dv = u - i, v - j
+
+        f = self.arr_frac
+        frac = (f[i, j] * (1 - du) * (1 - dv) + f[i + 1, j] * du * (1 - dv)
+            + f[i, j + 1] * (1 - du) * dv + f[i + 1, j + 1] * du * dv)
+
+        return np.where(arr_in, frac, 0.0)
+
+    def frac(self, theta, phi):
+        """
+        Coded fraction for arrays of BAT frame angles theta, phi (radians)
+        """
+
+        theta = np.asarray(theta, dtype=float)
+        arr_front = theta < np.pi / 2
+        tan_theta = np.tan(np.where(arr_front, theta, 0.0))
+
+        # back hemisphere is put outside the grid
+        x = np.where(arr_front, tan_theta * np.abs(np.cos(phi)), -1.0)
+        return self.interp(x, tan_theta * np.sin(phi))
+
+    def write(self, file_name, step, req_err):
+
+        atomic_file.write_npz(file_name, arr_x=self.arr_x, arr_y=self.arr_y, arr_frac=self.arr_frac,
+            max_err=self.max_err, step=step, req_err=req_err)
+
+def exact_frac(x, y):
+    """
+    Coded fraction from the mask geometry in the tangent plane points x >= 0, y
+    """
+
+    from get_coded_fov import bat_area
+
+    theta = np.arctan(np.hypot(x, y))
+    phi = np.arctan2(y, x)
+    return bat_area(theta, phi) / bat_area(0.0, 0.0)
+
+def make_grid(step, max_err, n_sub=8):
+    """
+    Grid with nodes step apart (tangent plane units), the step is halved until
+    the interpolation error at n_sub x n_sub points in each cell is below max_err
+    """
+
+    from get_coded_fov import mask_l, mask_w, det_l, det_w, efl
+
+    # the projected detector misses the mask outside this rectangle
+    x_max = (mask_l + det_l) / 2 / efl
+    y_max = (mask_w + det_w) / 2 / efl
+
+    while True:
+        nx = int(np.ceil(x_max / step)) + 1
+        ny = 2 * int(np.ceil(y_max / step)) + 1
+        arr_x = np.linspace(0, x_max, nx)
+        arr_y = np.linspace(-y_max, y_max, ny)
+        X, Y = np.meshgrid(arr_x, arr_y, indexing='ij')
+
+        grid = response_grid(arr_x, arr_y, exact_frac(X, Y), max_err)
+
+        # the interpolation error is checked at n_sub x n_sub points of each cell
+        err = 0.0
+        for k in range(n_sub):
+            x_sub = arr_x[:-1] + (arr_x[1] - arr_x[0]) * k / n_sub
+            for l in range(n_sub):
+                y_sub = arr_y[:-1] + (arr_y[1] - arr_y[0]) * l / n_sub
+                X, Y = np.meshgrid(x_sub, y_sub, indexing='ij')
+                err = max(err, np.max(np.abs(grid.interp(X, Y) - exact_frac(X, Y))))
+
+        print("BAT response grid {:d}x{:d}, step {:.5f}, interpolation error {:.2e}".format(nx, ny, arr_x[1], err))
+        if err <= max_err:
+            grid.max_err = err
+            return grid
+
+        step /= 2
+
+def load_grid(file_name=None, step=0.01, max_err=1e-3):
+    """
+    Response grid from the npz file if it was made with the same step and max_err,
+    otherwise a new one (the file is updated then)
+    """
+
+    if file_name is not None and os.path.isfile(file_name):
+        with np.load(file_name) as data:
+            if data['step'] == step and data['req_err'] == max_err:
+                return response_grid(data['arr_x'], data['arr_y'], data['arr_frac'], float(data['max_err']))
+
+    grid = make_grid(step, max_err)
+
+    if file_name is not None:
+        try:
+            grid.write(file_name, step, max_err)
+        except OSError as e:
+            print("Cannot save the response grid to {:s}: {:s}".format(file_name, str(e)))
+
+    return grid
+
+def get_grid():
+
+    global _grid
+    if _grid is None:
+        _grid = load_grid(conf.get('cf_grid'), conf.get('cf_grid_step', 0.01), conf.get('cf_grid_max_err', 1e-3))
+    return _grid
@@ -3,6 +3,11 @@ from __future__ import print_function
 
 import time
 import datetime
+import re
+import threading
+from bisect import bisect_right
+
+import numpy as np
 
 __version__ = "$Id: clock.py 233 2015-04-10 18:24:42Z lindy.blackburn@LIGO.ORG $"
 __author__ = "Lindy Blackburn"
@@ -52,21 +57,45 @@ fmtlist = """
 %j-%Y
 """.strip().split('\n')
 
+# fast path for the formats used in burst lists:
+# ISO 'YYYY-MM-DDThh:mm:ss.ffffff' (or with space instead of T) and 'YYYYMMDD SOD'
+iso_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?$')
+date_sod_re = re.compile(r'(\d{4})(\d{2})(\d{2})\s+(\d+(?:\.\d*)?)$')
+
+def parse_fast(timestring):
+    m = iso_re.match(timestring)
+    if m:
+        g = m.groups()
+        return datetime.datetime(int(g[0]), int(g[1]), int(g[2]), int(g[3]), int(g[4]), int(g[5]),
+            int(g[6].ljust(6, '0')) if g[6] else 0)
+    m = date_sod_re.match(timestring)
+    if m:
+        g = m.groups()
+        return datetime.datetime(int(g[0]), int(g[1]), int(g[2])) + datetime.timedelta(seconds=float(g[3]))
+    return None
+
+# last format that worked, per thread
+_parse_state = threading.local()
+
 # convert string to time tuple by trying different format templates until one is found
 def parsetime(timestring, fmt=None):
     if fmt is not None:
         return datetime.datetime.strptime(timestring, fmt)
     if timestring[:2] == "bn": # fermi trigger name
         return parsetime(timestring[2:8]) + datetime.timedelta(seconds=86.4 * float("0" + timestring[8:]))
+    t = parse_fast(timestring)
+    if t is not None:
+        return t
     try: # speed up by trying last format that worked first
-        return datetime.datetime.strptime(timestring, getattr(parsetime, 'lastfmt', fmtlist[0]))
-    except:
+        return datetime.datetime.strptime(timestring, getattr(_parse_state, 'lastfmt', fmtlist[0]))
+    except ValueError:
         None
     for fmt in fmtlist:
         try:
-            parsetime.lastfmt = fmt
-            return datetime.datetime.strptime(timestring, fmt)
-        except:
+            t = datetime.datetime.strptime(timestring, fmt)
+            _parse_state.lastfmt = fmt
+            return t
+        except ValueError:
             None
     raise TypeError("no format for timestring '" + timestring + "' found in " + repr(fmtlist))
 
@@ -83,7 +112,7 @@ def td2sec(td):
 # number of leap seconds that have elapsed between start and stop (datetime objects)
 # extra second occurs just before 00:00 UTC
 def leapseconds(start, stop):
-    return sum(1 for d in leapdates if d <= stop) - sum(1 for d in leapdates if d <= start)
+    return bisect_right(leapdates, stop) - bisect_right(leapdates, start)
 
 # convert UTC datetime object to GPS (seconds since gpsref)
 def utc2gps(timestruc):
@@ -91,12 +120,18 @@ def utc2gps(timestruc):
         timestruc = parsetime(timestruc)
     return td2sec(timestruc - gpsref) + leapseconds(gpsref, timestruc)
 
+# leap seconds in GPS seconds and fermi MET, computed once
+def _leapdates_since(ref):
+    leapdates_post = [timestruc for timestruc in leapdates if timestruc > ref]
+    return [td2sec(timestruc-ref)+1+i for (i, timestruc) in enumerate(leapdates_post)]
+
+leapdates_gps = _leapdates_since(gpsref)
+leapdates_met = _leapdates_since(fermiref)
+
 # convert GPS seconds to UTC datetime object
 def gps2utc(gps):
-    leapdates_post = [timestruc for timestruc in leapdates if timestruc > gpsref]
-    leapdates_gps = [td2sec(timestruc-gpsref)+1+i for (i, timestruc) in enumerate(leapdates_post)]
     # have two 00:00:00 times at leap second (same as xtime, not quite the same as the correct 23:59:60 just before)
-    return gpsref + datetime.timedelta(seconds=gps - sum(map(lambda x: x <= gps, leapdates_gps)))
+    return gpsref + datetime.timedelta(seconds=gps - bisect_right(leapdates_gps, gps))
 
 # convert UTC datetime object to fermi MET (seconds since fermiref)
 def utc2fermi(timestruc):
@@ -106,10 +141,8 @@ def utc2fermi(timestruc):
 
 # convert fermi MET to UTC datetime object
 def fermi2utc(met):
-    leapdates_post = [timestruc for timestruc in leapdates if timestruc > fermiref]
-    leapdates_met = [td2sec(timestruc-fermiref)+1+i for (i, timestruc) in enumerate(leapdates_post)]
     # have two 00:00:00 times at leap second (same as xtime, not quite the same as the correct 23:59:60 just before)
-    return fermiref + datetime.timedelta(seconds=met - sum(map(lambda x: x <= met, leapdates_met)))
+    return fermiref + datetime.timedelta(seconds=met - bisect_right(leapdates_met, met))
 
 # convert fermi MET to GPS seconds
 def fermi2gps(met):
@@ -141,3 +174,112 @@ def mjd2week(mjd):
 def week2mjd(week):
     return (week - 1)*7. + 50115.
 
+# array versions of the conversions above
+# UTC is numpy datetime64[us], GPS seconds and fermi MET are float arrays;
+# results are the same as of the scalar functions
+
+leapdates64 = np.array(leapdates, dtype='datetime64[us]')
+leapdates_gps64 = np.array(leapdates_gps)
+leapdates_met64 = np.array(leapdates_met)
+
+# convert datetime64, datetime or time string (or arrays of them) to datetime64[us] array
+def to_datetime64(timestruc):
+    arr = np.asarray(timestruc)
+    if arr.dtype.kind in 'US':
+        arr = np.array([parsetime(s) for s in arr.ravel()], dtype='datetime64[us]').reshape(arr.shape)
+    return arr.astype('datetime64[us]')
+
+# datetime64 difference to total seconds as td2sec does it
+def td2sec_array(td64):
+    us = td64.astype('timedelta64[us]').astype(np.int64)
+    return (us // 1000000) + (us % 1000000) / 1e6
+
+# datetime64 + float seconds, rounded to microseconds as datetime.timedelta(seconds=) does it
+def _add_seconds(ref64, sec):
+    sec_frac, sec_int = np.modf(np.asarray(sec, dtype=np.float64))
+    us = sec_int.astype(np.int64) * 1000000 + np.round(sec_frac * 1e6).astype(np.int64)
+    return ref64 + us.astype('timedelta64[us]')
+
+def leapseconds_array(start, stop):
+    return np.searchsorted(leapdates64, to_datetime64(stop), side='right') - \
+        np.searchsorted(leapdates64, to_datetime64(start), side='right')
+
+def utc2gps_array(timestruc):
+    t64 = to_datetime64(timestruc)
+    return td2sec_array(t64 - np.datetime64(gpsref, 'us')) + leapseconds_array(gpsref, t64)
+
+def gps2utc_array(gps):
+    gps = np.asarray(gps, dtype=np.float64)
+    return _add_seconds(np.datetime64(gpsref, 'us'), gps - np.searchsorted(leapdates_gps64, gps, side='right'))
+
+def utc2fermi_array(timestruc):
+    t64 = to_datetime64(timestruc)
+    return td2sec_array(t64 - np.datetime64(fermiref, 'us')) + leapseconds_array(fermiref, t64)
+
+def fermi2utc_array(met):
+    met = np.asarray(met, dtype=np.float64)
+    return _add_seconds(np.datetime64(fermiref, 'us'), met - np.searchsorted(leapdates_met64, met, side='right'))
+
+def utc2mjd_array(timestruc):
+    secondselapsed = td2sec_array(to_datetime64(timestruc) - np.datetime64(xteref, 'us'))
+    return 50115. + secondselapsed/86400.
+
+# convert list of time strings to datetime64[us] array,
+# ISO and 'YYYYMMDD SOD' strings are converted in bulk, others one by one with parsetime
+def parsetimes(lst_timestring):
+    lst_timestring = [str(s).strip() for s in lst_timestring]
+    n = len(lst_timestring)
+    arr_t = np.empty(n, dtype='datetime64[us]')
+
+    lst_iso, lst_sod, lst_other = [], [], []
+    for i, s in enumerate(lst_timestring):
+        if iso_re.match(s):
+            lst_iso.append(i)
+        elif date_sod_re.match(s):
+            lst_sod.append(i)
+        else:
+            lst_other.append(i)
+
+    if lst_iso:
+        arr_t[lst_iso] = np.array([lst_timestring[i] for i in lst_iso], dtype='datetime64[us]')
+
+    if lst_sod:
+        lst_split = [lst_timestring[i].split() for i in lst_sod]
+        arr_date = np.array(["{:s}-{:s}-{:s}".format(d[:4], d[4:6], d[6:8]) for d, _ in lst_split], dtype='datetime64[D]')
+        arr_sod = np.array([float(sod) for _, sod in lst_split])
+        arr_t[lst_sod] = _add_seconds(arr_date.astype('datetime64[us]'), arr_sod)
+
+    for i in lst_other:
+        arr_t[i] = np.datetime64(parsetime(lst_timestring[i]), 'us')
+
+    return arr_t
+
+# array conversions against the scalar ones on random times and around every leap second
+def test_array_conversions(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # random UTC from 1981 to 2030 and times within 2 s of every leap second, on both sides of 00:00
+    lst_utc = [gpsref + datetime.timedelta(seconds=s) for s in np.round(rng.uniform(0, 1.6e9, n), 6)]
+    lst_utc += [t + datetime.timedelta(seconds=s) for t in leapdates for s in (-2, -1, -0.5, -1e-6, 0, 1e-6, 0.5, 1, 2)]
+    t64 = np.array(lst_utc, dtype='datetime64[us]')
+
+    assert np.array_equal(utc2gps_array(t64), [utc2gps(t) for t in lst_utc])
+    assert np.array_equal(utc2fermi_array(t64), [utc2fermi(t) for t in lst_utc])
+    assert np.array_equal(utc2mjd_array(t64), [utc2mjd(t) for t in lst_utc])
+    assert np.array_equal(leapseconds_array(gpsref, t64), [leapseconds(gpsref, t) for t in lst_utc])
+
+    # GPS seconds and MET at the leap seconds, where two seconds map to the same 00:00:00
+    arr_gps = np.concatenate((np.round(rng.uniform(0, 1.6e9, n), 6),
+        [g + s for g in leapdates_gps for s in (-2, -1, -0.5, -1e-6, 0, 1e-6, 0.5, 1, 2)]))
+    arr_met = np.concatenate((np.round(rng.uniform(-6e8, 1e9, n), 6),
+        [m + s for m in leapdates_met for s in (-2, -1, -0.5, -1e-6, 0, 1e-6, 0.5, 1, 2)]))
+
+    assert np.array_equal(gps2utc_array(arr_gps), np.array([gps2utc(g) for g in arr_gps], dtype='datetime64[us]'))
+    assert np.array_equal(fermi2utc_array(arr_met), np.array([fermi2utc(m) for m in arr_met], dtype='datetime64[us]'))
+
+    # the leap second at the end of 2016 adds a second to the last day of the year
+    day = np.array(['2016-12-31', '2017-01-01'], dtype='datetime64[us]')
+    assert np.diff(utc2gps_array(day))[0] == 86401.0
+    assert gps2utc_array(utc2gps_array(day)[1] - 1.0) == gps2utc_array(utc2gps_array(day)[1])
+
+    print("Array conversions match the scalar ones")
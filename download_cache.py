@@ -0,0 +1,311 @@
+"""
+Managed cache of downloaded files
+
+Files are written to a temporary file and renamed into the cache directory
+when the transfer is complete. The manifest (SQLite, shared by the worker
+processes) keeps size, sha256, source url and last access time of every file.
+A file that is not in the manifest or does not match it is a cache miss.
+Least recently used files are removed when the cache is larger than max_bytes.
+Lock files are kept in the .locks subdirectory and removed on unlock. Partial
+downloads and lock files left by interrupted runs are removed at startup
+when they are older than stale_hours.
+"""
+import os
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+manifest_name = 'cache_manifest.sqlite'
+lock_dir_name = '.locks'
+
+def sha256sum(file_name, chunk_size=1 << 20):
+
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class download_cache:
+
+    def __init__(self, path, max_bytes=None, verify_checksum=False, stale_hours=24):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.verify_checksum = verify_checksum
+        self.stale_hours = stale_hours
+
+        self.hits = 0
+        self.misses = 0
+
+        self.db_file = os.path.join(path, manifest_name)
+        con = self._connect()
+        with con:
+            con.execute("""CREATE TABLE IF NOT EXISTS files
+                (name TEXT PRIMARY KEY, size INTEGER, sha256 TEXT, url TEXT, atime REAL)""")
+            con.execute("CREATE INDEX IF NOT EXISTS files_atime ON files (atime)")
+            con.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)")
+        con.close()
+
+        os.makedirs(os.path.join(path, lock_dir_name), exist_ok=True)
+        self.clean_stale()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def file_path(self, file_name):
+        return os.path.join(self.path, file_name)
+
+    def tmp_path(self, file_name):
+        return os.path.join(self.path, ".{:s}.{:d}.part".format(file_name, os.getpid()))
+
+    def part_path(self, file_name):
+        """
+        Partial file kept between attempts and runs to resume the download
+        """
+        return os.path.join(self.path, ".{:s}.part".format(file_name))
+
+    def lock_path(self, file_name):
+        return os.path.join(self.path, lock_dir_name, "{:s}.lock".format(file_name))
+
+    def _lock_file(self, lock_file, blocking=True):
+        """
+        Open and lock lock_file, returns the open file or None if it is locked by another process and not blocking
+        """
+
+        while True:
+            f = open(lock_file, 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return None
+
+            # the owner could remove the file while we waited for it, then lock the new one
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(lock_file)):
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def _unlock_file(self, f):
+
+        # removed while still locked, so no other process holds it
+        os.remove(f.name)
+        f.close()
+
+    @contextmanager
+    def lock(self, file_name):
+        """
+        Exclusive lock of file_name between processes (no lock where fcntl is not available)
+        """
+
+        if fcntl is None:
+            yield
+            return
+
+        f = self._lock_file(self.lock_path(file_name))
+        try:
+            yield
+        finally:
+            self._unlock_file(f)
+
+    def clean_stale(self):
+        """
+        Remove partial downloads and lock files (.<name>.part, .<name>.<pid>.part, .<name>.lock)
+        older than stale_hours which are not locked by another process
+        """
+
+        if not self.stale_hours:
+            return []
+
+        t_old = time.time() - self.stale_hours * 3600
+        lock_dir = os.path.join(self.path, lock_dir_name)
+
+        lst_files = [os.path.join(self.path, f) for f in os.listdir(self.path)
+            if f.startswith('.') and f.endswith(('.part', '.lock'))]
+        lst_files += [os.path.join(lock_dir, f) for f in os.listdir(lock_dir) if f.endswith('.lock')]
+
+        lst_removed = []
+        for local_file in lst_files:
+            try:
+                if os.path.getmtime(local_file) > t_old:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if fcntl is None:
+                self.discard(local_file)
+            elif local_file.endswith('.lock'):
+                # a lock file left by a killed process is removed as on unlock
+                f = self._lock_file(local_file, blocking=False)
+                if f is None:
+                    continue
+                self._unlock_file(f)
+            else:
+                # the resumable partial file is written under the lock of its name
+                f = self._lock_file(self.lock_path(os.path.basename(local_file)[1:-len('.part')]), blocking=False)
+                if f is None:
+                    continue
+                try:
+                    self.discard(local_file)
+                finally:
+                    self._unlock_file(f)
+
+            lst_removed.append(local_file)
+
+        if lst_removed:
+            print("Removed {:d} stale partial downloads and lock files from {:s}".format(len(lst_removed), self.path))
+
+        return lst_removed
+
+    def count(self, key):
+        """
+        Add a cache hit (key 'hits') or miss (key 'misses') to the stats of this process and of all runs
+        """
+
+        if key == 'hits':
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        con = self._connect()
+        with con:
+            con.execute("INSERT OR IGNORE INTO stats VALUES (?, 0)", (key,))
+            con.execute("UPDATE stats SET value = value + 1 WHERE key = ?", (key,))
+        con.close()
+
+    def lookup(self, file_name, count=True):
+        """
+        True if file_name is in the cache and matches the manifest.
+        A file that does not match is left to be replaced by a new download.
+        The result is counted as a hit or miss if count is True,
+        repeated checks of the same request (e.g. under the lock) should not count.
+        """
+
+        local_file = self.file_path(file_name)
+
+        con = self._connect()
+        row = con.execute("SELECT size, sha256 FROM files WHERE name = ?", (file_name,)).fetchone()
+        con.close()
+
+        good = row is not None and os.path.isfile(local_file) and os.path.getsize(local_file) == row[0]
+        if good and self.verify_checksum:
+            good = sha256sum(local_file) == row[1]
+
+        if not good:
+            if os.path.isfile(local_file):
+                print("{:s} does not match the cache manifest, download it again".format(local_file))
+            self.forget(file_name)
+            if count:
+                self.count('misses')
+            return False
+
+        con = self._connect()
+        with con:
+            con.execute("UPDATE files SET atime = ? WHERE name = ?", (time.time(), file_name))
+        con.close()
+
+        if count:
+            self.count('hits')
+        return True
+
+    def commit(self, file_name, tmp_file, url=''):
+        """
+        Move the complete tmp_file to the cache as file_name and add it to the manifest
+        """
+
+        size = os.path.getsize(tmp_file)
+        checksum = sha256sum(tmp_file)
+
+        local_file = self.file_path(file_name)
+        os.replace(tmp_file, local_file)
+
+        con = self._connect()
+        with con:
+            con.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (file_name, size, checksum, url, time.time()))
+        con.close()
+
+        self.evict()
+        return local_file
+
+    def discard(self, tmp_file):
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+    def forget(self, file_name):
+
+        con = self._connect()
+        with con:
+            con.execute("DELETE FROM files WHERE name = ?", (file_name,))
+        con.close()
+
+    def get_size(self):
+
+        con = self._connect()
+        size = con.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        con.close()
+        return size
+
+    def evict(self):
+        """
+        Remove least recently used files until the cache size is below max_bytes
+        """
+
+        if not self.max_bytes:
+            return []
+
+        con = self._connect()
+        lst_rows = con.execute("SELECT name, size FROM files ORDER BY atime DESC").fetchall()
+        con.close()
+
+        total = 0
+        lst_evict = []
+        for i, (name, size) in enumerate(lst_rows):
+            total += size
+            # the most recent file is kept even if it is larger than max_bytes
+            if i > 0 and total > self.max_bytes:
+                lst_evict.append(name)
+
+        for name in lst_evict:
+            print("Evict {:s} from the cache".format(name))
+            local_file = self.file_path(name)
+            if os.path.isfile(local_file):
+                os.remove(local_file)
+            self.forget(name)
+
+        return lst_evict
+
+    def get_stats(self):
+        """
+        Returns dict with hits and misses of this process and of all runs
+        """
+
+        con = self._connect()
+        dic_total = dict(con.execute("SELECT key, value FROM stats").fetchall())
+        con.close()
+
+        return {'hits': self.hits, 'misses': self.misses,
+            'total_hits': dic_total.get('hits', 0), 'total_misses': dic_total.get('misses', 0),
+            'size': self.get_size()}
+
+_dic_cache = {}
+
+def get_cache(path, max_size_gb=None, verify_checksum=False, stale_hours=24):
+    """
+    Returns the cache for the directory path, one per process
+    """
+
+    key = (os.path.abspath(path), os.getpid())
+    if key not in _dic_cache:
+        max_bytes = int(max_size_gb * 1024**3) if max_size_gb else None
+        _dic_cache[key] = download_cache(path, max_bytes, verify_checksum, stale_hours)
+    return _dic_cache[key]
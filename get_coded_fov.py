@@ -6,35 +6,197 @@ import os
 
 import numpy as np
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
-
 import swiftbat 
 
+import bat_response
+import text_writer
+
+import config
+
+conf = config.read_config('config.yaml')
+
 def code_ra_dec(ra, dec, p_ra, p_dec, p_roll):
   
     src = swiftbat.source.source(ra, dec)
     coded_area_in_cm2, cosfactor = src.exposure(p_ra, p_dec, p_roll)
     return coded_area_in_cm2
 
+# BAT detector plane and mask dimensions (m) and mask-detector distance, as in swiftbat.batExposure
+det_l = 286 * 4.2e-3
+det_w = 173 * 4.2e-3
+mask_l = 487 * 5.0e-3
+mask_w = 243 * 5.0e-3
+efl = 1.00
+
+# agreement of coded_area with code_ra_dec, cm^2 (numerical rounding only)
+coded_area_tol = 1e-6
+
+# the projected detector misses the mask beyond this off-axis angle (rad)
+max_off_axis = np.arctan(np.hypot((mask_l + det_l) / 2, (mask_w + det_w) / 2) / efl)
+
+# upper bound of the coded fraction change per radian on the sky:
+# the overlap area changes by at most the detector diagonal per unit shift of the projected mask,
+# the shift is at most sec^2(theta) per radian, the on-axis area is det_l * det_w
+coded_frac_slope = np.hypot(det_l, det_w) * (1 + np.tan(max_off_axis)**2) / (det_l * det_w)
+
+def bat_theta_phi(ra, dec, p_ra, p_dec, p_roll):
+    """
+    Angle from the boresight and phi angle in the BAT frame (radians) for sky directions ra, dec (deg)
+    and pointing p_ra, p_dec, p_roll (deg). All arguments may be arrays of broadcastable shapes.
+    """
+
+    lon1, lat1 = np.deg2rad(p_ra), np.deg2rad(p_dec)
+    lon2, lat2 = np.deg2rad(ra), np.deg2rad(dec)
+
+    sdlon, cdlon = np.sin(lon2 - lon1), np.cos(lon2 - lon1)
+    slat1, clat1 = np.sin(lat1), np.cos(lat1)
+    slat2, clat2 = np.sin(lat2), np.cos(lat2)
+
+    # Vincenty formula, as astropy separation
+    num1 = clat2 * sdlon
+    num2 = clat1 * slat2 - slat1 * clat2 * cdlon
+    theta = np.arctan2(np.hypot(num1, num2), slat1 * slat2 + clat1 * clat2 * cdlon)
+
+    # position angle is CCW, phi is CCW from +Y so (posang - roll - 90deg) gives phi
+    posang = np.arctan2(num1, num2)
+    phi = np.mod(posang - np.deg2rad(p_roll) - np.pi / 2 + np.pi, 2 * np.pi) - np.pi
+
+    return theta, phi
+
+def bat_area(theta, phi):
+    """
+    Open coded area (cm^2) for arrays of theta, phi (radians), vectorized swiftbat.batExposure
+    """
+
+    theta, phi = np.broadcast_arrays(np.asarray(theta, dtype=float), np.asarray(phi, dtype=float))
+    arr_front = theta < np.pi / 2
+    tan_theta = np.where(arr_front, np.tan(np.where(arr_front, theta, 0.0)), 0.0)
+
+    # projected detector put to the left of the mask center
+    dx = (mask_l - det_l) / 2 - efl * tan_theta * np.abs(np.cos(phi))
+    dy = (mask_w - det_w) / 2 + efl * tan_theta * np.sin(phi)
+
+    # boundaries of the detector as clipped to rectangle of mask
+    x1 = np.maximum(0, -dx)
+    delta_x = np.minimum(det_l, mask_l - dx) - x1
+    y1 = np.maximum(0, -dy)
+    delta_y = np.minimum(det_w, mask_w - dy) - y1
+
+    # cut corners of the mask
+    xint = (y1 + dy) - mask_w / 2 - (dx + x1)
+
+    lst_cond = [
+        (delta_x < 0) | (delta_y < 0),
+        xint <= -delta_y,
+        (xint <= 0) & (delta_y <= delta_x - xint),
+        xint <= 0,
+        (xint <= delta_x) & (xint <= delta_x - delta_y),
+        xint <= delta_x,
+    ]
+    lst_area = [
+        0.0,
+        delta_x * delta_y,
+        delta_x * delta_y - ((delta_y + xint) ** 2) / 2,
+        delta_x * -xint + (delta_x ** 2) / 2,
+        (delta_x - xint) * delta_y - (delta_y ** 2) / 2,
+        ((delta_x - xint) ** 2) / 2,
+    ]
+    area = np.select(lst_cond, lst_area, default=0.0)
+
+    # 1e4 for cm^2, 1/2 for open area
+    return np.where(arr_front, area * 1e4 / 2, 0.0)
+
+def coded_area(ra, dec, p_ra, p_dec, p_roll):
+    """
+    Open coded area (cm^2) for arrays of sky directions, same as code_ra_dec within coded_area_tol
+    """
+
+    return bat_area(*bat_theta_phi(ra, dec, p_ra, p_dec, p_roll))
+
+def coded_frac(ra, dec, p_ra, p_dec, p_roll, exact=None):
+    """
+    Coded fraction (coded area relative to the on-axis one) for arrays of sky directions,
+    interpolated in the response grid (bat_response) or from the exact geometry if exact is True.
+    exact=None takes cf_exact from config.yaml.
+    """
+
+    if exact is None:
+        exact = conf.get('cf_exact', False)
+
+    if exact:
+        return coded_area(ra, dec, p_ra, p_dec, p_roll) / coded_area(p_ra, p_dec, p_ra, p_dec, p_roll)
+
+    return bat_response.get_grid().frac(*bat_theta_phi(ra, dec, p_ra, p_dec, p_roll))
+
 def write_contours(lst_c, file_name):
+    """
+    Write contour lines to file_name, R.A. of lines joined across R.A. = 0 is wrapped to [0, 360)
+    """
 
     with open(file_name, 'w') as f:
         for c in lst_c:
            print("C found")
-           for i in range(c.shape[0]):
-               f.write("{:8.3f}  {:8.3f}\n".format(c[i,0], c[i,1]))
+           text_writer.write_rows(f, "%8.3f  %8.3f\n", np.mod(c[:,0], 360.0), c[:,1])
            f.write("--  --\n")
 
-def get_contours(cs):
+def _join_ra_wrap(lst_line, ra_min, ra_max, tol=1e-6):
+    """
+    Join contour lines cut at the ra_min and ra_max edges of a grid covering full circle in R.A.
+    The joined piece is shifted by the full circle, so R.A. of a joined line is continuous
+    and may go below ra_min or above ra_max (write_contours wraps it back).
+    """
+
+    period = ra_max - ra_min
+    lst_line = [l for l in lst_line]
+    lst_res = []
+
+    def on_edge(point):
+        return abs(np.remainder(point[0] - ra_min + tol, period) - tol) < tol
+
+    def same_point(p1, p2):
+        # the edges are the same meridian
+        return abs(p1[1] - p2[1]) < tol and abs(np.remainder(p1[0] - p2[0] + tol, period) - tol) < tol
+
+    while lst_line:
+        line = lst_line.pop()
+        joined = True
+        while joined and on_edge(line[-1]):
+            joined = False
+            for i, other in enumerate(lst_line):
+                if same_point(line[-1], other[-1]):
+                    other = other[::-1]
+                elif not same_point(line[-1], other[0]):
+                    continue
+                # the first vertex of other duplicates the last one of line
+                other = other[1:] + [line[-1][0] - other[0][0], 0.0]
+                line = np.concatenate((line, other))
+                lst_line.pop(i)
+                joined = True
+                break
+        lst_res.append(line)
+
+    return lst_res
+
+def get_contours(ra, dec, Z, levels):
+    """
+    Contour lines (arrays of R.A., Dec. vertices) of Z on the grid of ra, dec (1D, deg)
+    for each of levels. The grid has to cover R.A. from 0 to 360 deg inclusive,
+    lines crossing R.A. = 0 are joined.
+    """
+
+    import contourpy
+
+    gen = contourpy.contour_generator(ra, dec, Z, line_type=contourpy.LineType.Separate)
 
     lines = []
-    for lines_c in cs.collections:
-        print(lines_c)
-        for line in lines_c.get_paths():
-            lines.append(line.vertices)
+    for level in np.atleast_1d(levels):
+        lines.extend(_join_ra_wrap(gen.lines(level), ra[0], ra[-1]))
+
+    # vertices of a contour are within a grid cell from each other
+    d_ra = np.max(np.abs(np.diff(ra)))
+    for line in lines:
+        if line.shape[0] > 1 and np.max(np.abs(np.diff(line[:,0]))) > d_ra * (1 + 1e-6):
+            raise ValueError("Contour line jumps in R.A. by more than the grid step")
 
     return lines
 
@@ -54,6 +216,8 @@ def test_fov():
     Z = vfumc(X, Y) / s0
     #print(Z)
    
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(5,5))
     im = ax.imshow(Z, extent=(-65, 65, -65, 65), origin='lower') #, interpolation='bilinear', origin='lower', cmap=cm.gray,)
 
@@ -61,7 +225,7 @@ def test_fov():
     CS = ax.contour(X, Y, Z, levels, colors='k')
     #ax.clabel(CS, inline=1, fontsize=10)
 
-    lst_c = get_contours(CS)
+    lst_c = [p.vertices for p in CS.get_paths()]
     write_contours(lst_c, 'cont.txt')
 
     ax.set_title('BAT coding fraction')
@@ -70,72 +234,191 @@ def test_fov():
 
     plt.savefig('bat.png')
 
-def get_fov(p_ra, p_dec, p_roll, level, file_name):
-
-    ra_bounds = (360, 0.0)
-    dec_bounds = (-90, 90)
+def get_cf_grid(p_ra, p_dec, p_roll, step=2.0):
+    """
+    Coded fraction Z[dec, ra] on the grid of R.A. from 0 to 360 deg and Dec. from -90 to 90 deg with step (deg)
+    """
 
-    ra = np.arange(ra_bounds[0], ra_bounds[1], -2.0)
-    dec = np.arange(dec_bounds[0], dec_bounds[1], 2.0)
+    ra = np.linspace(0.0, 360.0, int(round(360.0 / step)) + 1)
+    dec = np.linspace(-90.0, 90.0, int(round(180.0 / step)) + 1)
 
     X, Y = np.meshgrid(ra, dec)
-    #print(X, Y)
-    
-    s0 = code_ra_dec(p_ra, p_dec, p_ra, p_dec, p_roll)
+    Z = coded_frac(X, Y, p_ra, p_dec, p_roll)
+
+    return ra, dec, Z
+
+def plot_fov(ra, dec, Z, lst_c, file_name):
+    """
+    Save the coded fraction map with contours lst_c to the PNG file_name
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-    vfumc = np.vectorize(code_ra_dec, excluded=['p_ra', 'p_dec', 'p_roll'])
-    #print(vfumc([0,60], [0, 20]))
-    #exit()
-    Z = vfumc(X, Y, p_ra, p_dec, p_roll) / s0
-    #print(Z)
-   
     fig, ax = plt.subplots(figsize=(8,8))
-    im = ax.imshow(Z, extent=(ra_bounds[0], ra_bounds[1], dec_bounds[0], dec_bounds[1]), origin='lower') #, interpolation='bilinear', origin='lower', cmap=cm.gray,)
+    ax.imshow(Z, extent=(ra[0], ra[-1], dec[0], dec[-1]), origin='lower')
 
-    
-    CS = ax.contour(X, Y, Z, levels=[level,], colors='k')
-    #ax.clabel(CS, inline=1, fontsize=10)
+    # joined lines may cross R.A. = 0, their parts beyond the edges are drawn on the other side
+    period = ra[-1] - ra[0]
+    for c in lst_c:
+        for shift in (-period, 0.0, period):
+            ax.plot(c[:,0] + shift, c[:,1], color='k', lw=1)
 
-    lst_c = get_contours(CS)
-    write_contours(lst_c, file_name)
+    ax.set_xlim(ra[-1], ra[0])
+    ax.set_ylim(dec[0], dec[-1])
 
     ax.set_title('BAT coding fraction')
     ax.set_xlabel('R.A. (deg)')
     ax.set_ylabel('Dec (deg)')
 
+    fig.savefig(file_name)
+    plt.close(fig)
+
+def get_fov(p_ra, p_dec, p_roll, level, file_name, plot=True):
+    """
+    Write the contours of the coded fraction level to file_name and,
+    if plot is True, the map to the PNG file with the same name
+    """
+
+    ra, dec, Z = get_cf_grid(p_ra, p_dec, p_roll)
+
+    lst_c = get_contours(ra, dec, Z, level)
+    write_contours(lst_c, file_name)
+
+    if plot:
+        plot_fov(ra, dec, Z, lst_c, "{:s}.png".format(os.path.splitext(file_name)[0]))
+
+def get_coded_pix(p_ra, p_dec, p_roll, code_frac, nside, nside_start=8):
+    """
+    Nested HEALPix pixels at nside with the coded fraction above code_frac at the pixel center.
+    Pixels far from the boresight are rejected at once, the coarse pixels which are
+    entirely above or below code_frac (by coded_frac_slope) are not refined.
+    Same result as the evaluation of all pixels.
+    """
+
+    import healpy as hp
+
+    nside_c = min(nside_start, nside)
+    vec = hp.ang2vec(p_ra, p_dec, lonlat=True)
+    arr_pix = hp.query_disc(nside_c, vec, max_off_axis, inclusive=True, nest=True)
+
+    lst_pix = []
+    while True:
+        ra, dec = hp.pix2ang(nside_c, arr_pix, nest=True, lonlat=True)
+        f = coded_frac(ra, dec, p_ra, p_dec, p_roll)
+
+        if nside_c == nside:
+            lst_pix.append(arr_pix[f > code_frac])
+            break
 
-    plt.savefig("{:s}.png".format(os.path.splitext(file_name)[0]))
+        # centers of all sub-pixels are within max_pixrad from the center
+        margin = coded_frac_slope * hp.max_pixrad(nside_c)
+        arr_above = f - margin > code_frac
+        arr_mixed = ~arr_above & (f + margin > code_frac)
 
-def get_fov_hpx(p_ra, p_dec, p_roll, code_frac, file_name):
+        n_sub = (nside // nside_c)**2
+        lst_pix.append((arr_pix[arr_above][:,None] * n_sub + np.arange(n_sub)).ravel())
+
+        arr_pix = (arr_pix[arr_mixed][:,None] * 4 + np.arange(4)).ravel()
+        nside_c *= 2
+
+    return np.sort(np.concatenate(lst_pix))
+
+def get_fov_hpx(p_ra, p_dec, p_roll, code_frac, file_name, nside=64, adaptive=True):
+    """
+    Nested HEALPix map with 0 where the coded fraction is above code_frac, 1 elsewhere.
+    adaptive=False evaluates the coded fraction for all pixels.
+    """
 
     from mhealpy import HealpixMap
 
     # Define the grid
-    nside = 64
     scheme = 'nested'
-    is_nested = (scheme == 'nested')
-
-    m = HealpixMap(nside = nside, scheme = scheme, dtype = float)
 
     # Initialize the "map", which is a simple array
-    data = np.ones(m.npix)
+    data = np.ones(12 * nside**2)
 
     m = HealpixMap(data=data, nside = nside, scheme = scheme, dtype = float)
 
-    s0 = code_ra_dec(p_ra, p_dec, p_ra, p_dec, p_roll)
-
-    for i in range(m.npix):
-
-        theta, phi =  m.pix2ang(i)
+    if adaptive:
+        m[get_coded_pix(p_ra, p_dec, p_roll, code_frac, nside)] = 0.0
+    else:
+        theta, phi =  m.pix2ang(np.arange(m.npix))
         ra = np.rad2deg(phi)
         dec = 90.0 - np.rad2deg(theta)
 
-        f = code_ra_dec(ra, dec, p_ra, p_dec, p_roll)
-        if f/s0 > code_frac:
-            m[i] = 0.0
+        f = coded_frac(ra, dec, p_ra, p_dec, p_roll)
+        m[f > code_frac] = 0.0
 
     m.write_map(file_name, overwrite=True)
 
+def get_cf_hpx(p_ra, p_dec, p_roll, nside):
+    """
+    Coded fraction in nested HEALPix pixels at nside, zero beyond max_off_axis from the boresight
+    """
+
+    import healpy as hp
+
+    arr_cf = np.zeros(hp.nside2npix(nside))
+
+    vec = hp.ang2vec(p_ra, p_dec, lonlat=True)
+    arr_pix = hp.query_disc(nside, vec, max_off_axis, inclusive=True, nest=True)
+
+    ra, dec = hp.pix2ang(nside, arr_pix, nest=True, lonlat=True)
+    arr_cf[arr_pix] = coded_frac(ra, dec, p_ra, p_dec, p_roll)
+
+    return arr_cf
+
+def write_hpx(data, file_name):
+
+    from mhealpy import HealpixMap
+
+    m = HealpixMap(data=data, scheme = 'nested', dtype = float)
+    m.write_map(file_name, overwrite=True)
+
+def get_fov_products(p_ra, p_dec, p_roll, levels, file_prefix, nside=64, plot=True, cf_map=False):
+    """
+    FoV products for the list of coded fraction levels from one evaluation of the coded fraction grid:
+    <file_prefix>_bat_fov_cont_cfXX.txt contours (and PNG maps if plot is True),
+    <file_prefix>_bat_fov_cfXX_hpx.fits HEALPix masks (0 where the coded fraction is above the level),
+    <file_prefix>_bat_fov_cf_hpx.fits coded fraction HEALPix map if cf_map is True.
+    The masks are made from the coded fraction map if it is saved, by get_coded_pix otherwise.
+    Returns list of the files written.
+    """
+
+    ra, dec, Z = get_cf_grid(p_ra, p_dec, p_roll)
+    arr_cf = get_cf_hpx(p_ra, p_dec, p_roll, nside) if cf_map else None
+
+    lst_file = []
+    for level in levels:
+
+        file_name = "{:s}_bat_fov_cont_cf{:02d}.txt".format(file_prefix, int(level*100))
+        lst_c = get_contours(ra, dec, Z, level)
+        write_contours(lst_c, file_name)
+        lst_file.append(file_name)
+
+        if plot:
+            file_name = "{:s}.png".format(os.path.splitext(file_name)[0])
+            plot_fov(ra, dec, Z, lst_c, file_name)
+            lst_file.append(file_name)
+
+        file_name = "{:s}_bat_fov_cf{:02d}_hpx.fits".format(file_prefix, int(level*100))
+        if arr_cf is None:
+            data = np.ones(12 * nside**2)
+            data[get_coded_pix(p_ra, p_dec, p_roll, level, nside)] = 0.0
+        else:
+            data = np.where(arr_cf > level, 0.0, 1.0)
+        write_hpx(data, file_name)
+        lst_file.append(file_name)
+
+    if cf_map:
+        file_name = "{:s}_bat_fov_cf_hpx.fits".format(file_prefix)
+        write_hpx(arr_cf, file_name)
+        lst_file.append(file_name)
+
+    return lst_file
+
 def test_src():
 
     src_ra, src_dec = 62.7894, -51.5326
@@ -7,15 +7,20 @@ import ftplib
 from ftplib import FTP, FTP_TLS
 import datetime
 import re
+import traceback
+from contextlib import ExitStack
+from multiprocessing import Pool
 
 import numpy as np
 
 from swift_bat_rate_lc import swift_bat_lc 
-from plot_swift_bat import plot_bat
-from get_swift_obs_info import get_obsid, get_pointing, download_file
-from get_coded_fov import get_fov, get_fov_hpx
+import plot_swift_bat
+from get_swift_obs_info import get_obsid, get_pointing, download_file, get_cache
+from get_coded_fov import get_fov_products
 
 import config 
+import heasarc_ftp
+import orig_segment
 
 conf = config.read_config('config.yaml')
 
@@ -64,23 +69,131 @@ def nlst(ftp, str_pattern):
         print("No {:s} files in directory".format(str_pattern))
     return files
 
-def download(ftp, path, file_ftp, str_pattern):
+def download(ftp, path, file_ftp, str_pattern, ftp_dir=None):
+    """
+    Download files from file_ftp that are not in the download cache of path yet.
+    ftp is either a connected FTP session already in ftp_dir
+    or a heasarc_ftp.ftp_pool, then files are fetched from ftp_dir concurrently.
+    The files are locked in the cache while they are fetched, so parallel workers
+    do not fetch the same file.
+    """
 
-    path_folder = os.listdir(path)
-    file_folder = list(filter(lambda x: x.startswith(str_pattern), path_folder))
+    cache = get_cache(path)
+    lst_new = [f for f in file_ftp if not cache.lookup(f)]
 
-    if file_ftp != file_folder:
-        for f in sorted(set(file_ftp) - set(file_folder)):
-            print(f"Downloading {f}")
-            ftp.retrbinary(f'RETR {f}', open(path+'/'+f,'wb').write)
-    else:
+    if len(lst_new) == 0:
         print("No new files in format {:s}".format(str_pattern))
+        return
+
+    with ExitStack() as stack:
+        # all processes lock files in the same order
+        for f in sorted(lst_new):
+            stack.enter_context(cache.lock(f))
+
+        # another process could download them while we waited for the locks
+        lst_new = [f for f in lst_new if not cache.lookup(f, count=False)]
+
+        dic_tmp = {f: cache.tmp_path(f) for f in lst_new}
+        try:
+            if isinstance(ftp, heasarc_ftp.ftp_pool):
+                heasarc_ftp.fetch_files(ftp, [(ftp_dir, f, dic_tmp[f]) for f in lst_new])
+            else:
+                for f in lst_new:
+                    print(f"Downloading {f}")
+                    with open(dic_tmp[f],'wb') as fw:
+                        ftp.retrbinary(f'RETR {f}', fw.write)
+        except BaseException:
+            for f in lst_new:
+                cache.discard(dic_tmp[f])
+            raise
+
+        for f in lst_new:
+            url = "ftp://{:s}/{:s}/{:s}".format(heasarc_ftp.heasarc_server, ftp_dir if ftp_dir else ftp.pwd().lstrip('/'), f)
+            cache.commit(f, dic_tmp[f], url)
+
+# rate products by resolution
+dic_res_product = {'1s':'brt1s', 'ms':'brtms', 'qd':'brtqd', 'mc':'brtmc'}
+
+# *lc* listings of HEASARC rate directories already seen in this process
+dic_ftp_listing = {}
+
+def get_product_file(obsid, res):
+    """
+    Returns the rate file name for the resolution res, e.g. sw00100319000brtms.lc.gz
+    """
+
+    if res not in dic_res_product:
+        raise ValueError(f'Wrong resolution {res}')
+    return f'sw{obsid}{dic_res_product[res]}.lc.gz'
+
+def select_files(all_files, name, products):
+    """
+    Select files of the given products (e.g. ['brtms']) from the listing, all files if products is None
+    """
 
-def download_swift_heasarc(date, obsid, path):
+    if products is None:
+        return all_files
+    return [f for f in all_files if any(f.startswith(name + p) for p in products)]
+
+def have_files(path, lst_files):
+    """
+    True if all files are in the cache, they are counted as cache hits then.
+    Otherwise nothing is counted, download() counts the files.
+    """
+
+    cache = get_cache(path)
+    if not all([cache.lookup(f, count=False) for f in lst_files]):
+        return False
+
+    for f in lst_files:
+        cache.count('hits')
+    return True
+
+def download_swift_heasarc_pool(date, obsid, path, products=None):
+
+    print(date, obsid, path)
+    ftp_dir = "swift/data/obs/{:s}_{:s}/{:s}/bat/rate".format(date[0:4], date[4:6], obsid)
+
+    pool = heasarc_ftp.get_pool(conf['ftp_pool_size'])
+    name = 'sw{:s}'.format(obsid)
+
+    all_files = dic_ftp_listing.get(ftp_dir)
+    if all_files is None:
+        try:
+            all_files = pool.nlst(ftp_dir, name+'*lc*')
+        except ftplib.error_perm:
+            print("The folder {:s} does not exist!".format(ftp_dir))
+            return None
+        dic_ftp_listing[ftp_dir] = all_files
+
+    print("Path of the ftp directory: {:s}".format(ftp_dir))
+    print(all_files)
+
+    files = select_files(all_files, name, products)
+    download(pool, path, files, name, ftp_dir)
+    return files
+
+def download_swift_heasarc(date, obsid, path, products=None):
+    """
+    Download rate files of obsid. products is a list of products to fetch, e.g. ['brtms'],
+    all *lc* files of the obsid are fetched if products is None.
+    Returns the list of the files, None if the obsid folder does not exist.
+    """
+
+    if conf.get('ftp_pool_size', 0) > 0:
+        return download_swift_heasarc_pool(date, obsid, path, products)
 
     print(date, obsid, path)
     server = 'heasarc.gsfc.nasa.gov'
     ftp_dir = "swift/data/obs/{:s}_{:s}/{:s}/bat/rate".format(date[0:4], date[4:6], obsid)
+    name = 'sw{:s}'.format(obsid)
+
+    all_files = dic_ftp_listing.get(ftp_dir)
+    if all_files is not None:
+        files = select_files(all_files, name, products)
+        if have_files(path, files):
+            print("All {:s} files are already downloaded".format(name))
+            return files
 
     print("Connecting to {:s}...".format(server))
     ftp = FTP_TLS(server)
@@ -92,15 +205,17 @@ def download_swift_heasarc(date, obsid, path):
         ftp.cwd(ftp_dir)
         print("Path of the ftp directory: {:s}".format(ftp_dir))
     
-        name = 'sw{:s}'.format(obsid)
-        all_files = nlst(ftp, name+'*lc*')
+        if all_files is None:
+            all_files = nlst(ftp, name+'*lc*')
+            dic_ftp_listing[ftp_dir] = all_files
         print(all_files)
 
-        download(ftp, path, all_files, name)
+        files = select_files(all_files, name, products)
+        download(ftp, path, files, name, ftp_dir)
 
         ftp.quit()
         print("All done, disconnect")
-        return all_files
+        return files
 
     except ftplib.error_perm:
         print("The folder {:s} does not exist!".format(ftp_dir))
@@ -108,86 +223,122 @@ def download_swift_heasarc(date, obsid, path):
         print("Disconnect")
         return None
 
-def download_swift_orig(date, obsid, path):
+def download_swift_orig(date, obsid, path, product='brtms'):
 
     print(date, obsid, path)
 
-    for idx in range(25):
-        url = 'https://swift.gsfc.nasa.gov/data/swift/.original/sw{0:s}.{1:03d}/data/bat/rate/sw{0:s}brtms.lc.gz'.format(obsid, idx)
+    seg_file = os.path.join(path, 'orig_segments.json')
+
+    # one retry with new probing if the remembered segment is gone
+    for attempt in range(2):
+        idx = orig_segment.find_segment(obsid, product, seg_file)
+        if idx is None:
+            return None
+
+        url = orig_segment.get_orig_url(obsid, idx, product)
         try:
             file_name = download_file(url, path)
             print(f'{idx} is good, got {file_name}')
             return file_name
-            break
 
         except Exception as e:
             print(str(e))
+            orig_segment.forget_segment(obsid, seg_file)
 
     return None
 
-def plot(lc, res, path):
+def get_res_name(res_ms):
+    """
+    64 -> '64ms', 1000 -> '1s'
+    """
+
+    if res_ms % 1000 == 0:
+        return "{:d}s".format(res_ms // 1000)
+    return "{:d}ms".format(res_ms)
 
-    arr_ti, arr_rate = lc.get_lc()
+def plot(lc, res, path, factor=1):
+
+    arr_ti, arr_rate = lc.get_lc(factor)
     event_name = lc.get_ipn_name()
 
     arr_begin_end = np.array([-50,50])
-    res_ms = 1000
-    if res == 'ms':
-        res = '64' + res
-        res_ms = 64
+    res_ms = lc.get_res_ms(factor)
 
-    plot_name = "{:s}/{:s}_BAT_{:s}.png".format(path, event_name, res)
+    plot_name = "{:s}/{:s}_BAT_{:s}.png".format(path, event_name, get_res_name(res_ms))
     caption = "Swift-BAT {:s}".format(lc.get_date_time())
-    plot_bat(arr_ti, arr_rate, res_ms, arr_begin_end, plot_name, caption)
+    plot_swift_bat.submit_plot(arr_ti, arr_rate, res_ms, arr_begin_end, plot_name, caption,
+        n_workers=conf.get('plot_workers', 0))
 
 def get_files(date, obsid, res, path_to_down):
 
-    if res == '1s':
-        file_name = f'sw{obsid}brt1s.lc.gz' 
-    elif res == 'ms':
-        file_name = f'sw{obsid}brtms.lc.gz' 
-    else:
-        print(f'Wrong resolution {res}')
-        exit()
+    file_name = get_product_file(obsid, res)
+    product = dic_res_product[res]
 
     if conf['data_source'] == 'HEASARC':
-        all_files = download_swift_heasarc(date, obsid, path_to_down)
+        all_files = download_swift_heasarc(date, obsid, path_to_down, products=[product])
     else:
-        all_files = download_swift_orig(date, obsid, path_to_down)
+        all_files = download_swift_orig(date, obsid, path_to_down, product)
 
     print(f'Needed {file_name} got {all_files}')
 
     if all_files is None:
         return None
 
+    if not os.path.isfile(os.path.join(path_to_down, file_name)):
+        print(f'No {file_name} for obsid {obsid}')
+        return None
+
     return os.path.join(path_to_down, file_name)
 
-def get_data(trigger_time, path_to_down, path_to_save):
+# part of the lightcurve read from the file, s relative to T0,
+# a bit wider than the interval written by swift_bat_lc.write_ascii
+lc_window = (-1001.0, 5001.0)
+
+def load_lc(trigger_time, path_to_down, res='ms', window=lc_window):
+    """
+    Download and read the lightcurve around trigger_time ('YYYY-MM-DDThh:mm:ss.sss'),
+    the next obsid is used if the lightcurve ends before trigger_time.
+    Returns (swift_bat_lc, obsid) or (None, obsid)
+    """
 
     date = get_date(trigger_time)
     obsid, obsid_next = get_obsid(trigger_time)
-    
-    #res ='1s' 
-    res ='ms'
 
     lc_file = get_files(date, obsid, res, path_to_down)
     if lc_file is None:
-        return None
+        return None, obsid
     
-    lc = swift_bat_lc(lc_file, trigger_time, res)
-    event_name = lc.get_ipn_name()
+    lc = swift_bat_lc(lc_file, trigger_time, res, window)
 
     ti_lc, tf_lc = lc.get_ti_tf()
 
     if tf_lc < 0.0 and obsid_next is not None:
         print(f"Lightcurve for obsid {obsid} is short, try obsid {obsid_next}...")
-        lc_file = get_files(date, obsid_next, res, path_to_down)
-        lc = swift_bat_lc(lc_file, trigger_time, res)
+        lc_file_next = get_files(date, obsid_next, res, path_to_down)
+        if lc_file_next is not None:
+            lc = swift_bat_lc(lc_file_next, trigger_time, res, window)
+            obsid = obsid_next
+
+    return lc, obsid
+
+def get_data(trigger_time, path_to_down, path_to_save):
+
+    #res ='1s' 
+    res ='ms'
+
+    lc, obsid = load_lc(trigger_time, path_to_down, res)
+    if lc is None:
+        return None
+
+    event_name = lc.get_ipn_name()
+
+    # .thr files and plots for each rebin factor of the native resolution
+    for factor in conf.get('lc_rebin', [1]):
+        ascii_lc_file = "{:s}/{:s}_BAT{:d}.thr".format(path_to_save, event_name, lc.get_res_ms(factor))
+        lc.write_ascii(ascii_lc_file, factor)
 
-    ascii_lc_file = "{:s}/{:s}_BAT64.thr".format(path_to_save, event_name)
-    lc.write_ascii(ascii_lc_file)
+        plot(lc, res, path_to_save, factor)
 
-    plot(lc, res, path_to_save)
     return event_name
 
 
@@ -202,6 +353,75 @@ def read_burst_list(file_name):
 
     return list(filter(len, lst_date_time))
 
+def process_burst(date_time, coded_frac_levels=(0.1,)):
+    """
+    Get lightcurve, pointing and FoV products for one 'YYYYMMDD SSSSS.sss' burst list entry
+    """
+
+    path_to_save = conf['save_path']
+
+    time_iso = date_time_sod_to_iso(date_time)
+    event_name = get_data(time_iso, conf['download_path'], path_to_save)
+    if event_name is None:
+        print("No data to process!")
+        #continue
+
+    event_name = get_ipn_name(date_time.split()[0], float(date_time.split()[1]))
+
+    t_utc, lst_ra_dec_roll = get_pointing(time_iso, conf['download_path'], path_to_save)
+
+    file_prefix = "{:s}/{:s}".format(path_to_save, event_name)
+    get_fov_products(*lst_ra_dec_roll, coded_frac_levels, file_prefix, nside=conf.get('fov_nside', 64),
+        plot=conf.get('fov_png', True), cf_map=conf.get('fov_cf_map', False))
+
+    # lightcurve plots may still be rendered in background
+    plot_swift_bat.wait_plots()
+
+    return event_name
+
+def _process_burst_safe(args):
+    """
+    Pool worker: a failing burst is reported, not propagated to the other bursts
+    """
+
+    date_time, coded_frac_levels = args
+    try:
+        return date_time, process_burst(date_time, coded_frac_levels), None
+    except (Exception, SystemExit) as e:
+        traceback.print_exc()
+        # plots of the failed burst are not reported with the next one
+        try:
+            plot_swift_bat.wait_plots()
+        except Exception:
+            traceback.print_exc()
+        return date_time, None, "{:s}: {:s}".format(type(e).__name__, str(e))
+
+def process_burst_list(lst_date_time, coded_frac_levels=(0.1,), n_workers=1):
+    """
+    Process the burst list with n_workers processes.
+    Returns list of (date_time, error) for failed bursts.
+    """
+
+    lst_args = [(date_time, coded_frac_levels) for date_time in lst_date_time]
+
+    if n_workers > 1:
+        with Pool(processes=n_workers) as pool:
+            lst_res = list(pool.imap_unordered(_process_burst_safe, lst_args, chunksize=1))
+    else:
+        lst_res = [_process_burst_safe(args) for args in lst_args]
+
+    lst_failed = [(date_time, err) for date_time, _, err in lst_res if err is not None]
+
+    print("Processed {:d} bursts, {:d} failed".format(len(lst_res), len(lst_failed)))
+    for date_time, err in lst_failed:
+        print("  {:s}: {:s}".format(date_time, err))
+
+    dic_stats = get_cache(conf['download_path']).get_stats()
+    print("Download cache: {:d} hits, {:d} misses in total, {:.1f} MB".format(
+        dic_stats['total_hits'], dic_stats['total_misses'], dic_stats['size'] / 1024**2))
+
+    return lst_failed
+
 if __name__ == '__main__':
 
     #str_date_time = '20110526  61739.032'
@@ -211,28 +431,8 @@ if __name__ == '__main__':
         if not os.path.isdir(s):
             os.mkdir(s)
 
-
     lst_date_time = read_burst_list(conf['burst_list'])
-    path_to_save = conf['save_path']
-
-    
-
-    coded_frac_level = 0.1 #0.2, 0.5
-
-    for date_time in lst_date_time:
-
-        time_iso = date_time_sod_to_iso(date_time)
-        event_name = get_data(time_iso, conf['download_path'], path_to_save)
-        if event_name is None:
-            print("No data to process!")
-            #continue
-
-        event_name = get_ipn_name(date_time.split()[0], float(date_time.split()[1]))
-        
-        t_utc, lst_ra_dec_roll = get_pointing(time_iso, conf['download_path'], path_to_save)
 
-        file_name = "{:s}/{:s}_bat_fov_cont_cf{:02d}.txt".format(path_to_save, event_name, int(coded_frac_level*100)) 
-        get_fov(*lst_ra_dec_roll, coded_frac_level, file_name)
+    coded_frac_levels = conf.get('coded_frac_levels', [0.1,]) #0.2, 0.5
 
-        file_name = "{:s}/{:s}_bat_fov_cf{:02d}_hpx.fits".format(path_to_save, event_name, int(coded_frac_level*100))
-        get_fov_hpx(*lst_ra_dec_roll, coded_frac_level, file_name)
\ No newline at end of file
+    process_burst_list(lst_date_time, coded_frac_levels, conf.get('n_workers', 1))
@@ -1,7 +1,5 @@
 """
 """
-import os
-
 from datetime import datetime
 import requests
 
@@ -13,9 +11,12 @@ from astropy.table import Table
 from astropy.io import ascii
 from astropy.io import fits
 
-import swiftbat
-
 import clock
+import download_cache
+import http_download
+import text_writer
+import utcf_cache
+from schedule_store import schedule_store
 
 import config 
 
@@ -25,21 +26,47 @@ proxy = {'http': conf['proxy']}
 if proxy == '' or proxy == 'None':
     proxy = None
 
+def get_cache(path):
+    return download_cache.get_cache(path, conf.get('cache_max_size_gb'), conf.get('cache_verify_checksum', False),
+        conf.get('cache_stale_hours', 24))
+
 def download_file(url, path):
+    """
+    Download url to the cache in path, streaming in chunks and resuming partial files
+    """
 
-    file_name = os.path.join(path, url.split('/')[-1]) 
+    file_name = url.split('/')[-1]
+    cache = get_cache(path)
 
-    if os.path.isfile(file_name):
-        return file_name
+    if cache.lookup(file_name):
+        return cache.file_path(file_name)
 
-    response = requests.get(url, proxies=proxy, verify=False)
-    response.raise_for_status()
-    with open(file_name, 'wb') as f:
-        f.write(response.content)
+    with cache.lock(file_name):
 
-    return file_name
+        # another process could download it while we waited for the lock
+        if cache.lookup(file_name, count=False):
+            return cache.file_path(file_name)
 
-def get_table(date):
+        part_file = cache.part_path(file_name)
+        n_attempts = conf.get('download_retries', 3)
+        for attempt in range(n_attempts):
+            try:
+                http_download.stream_download(url, part_file, proxy, int(conf.get('download_chunk_mb', 1) * 1024**2))
+                break
+            except requests.HTTPError:
+                cache.discard(part_file)
+                raise
+            except (requests.RequestException, IOError) as e:
+                print("Download attempt {:d} of {:s} failed: {:s}".format(attempt + 1, url, str(e)))
+                if attempt == n_attempts - 1:
+                    raise
+
+        return cache.commit(file_name, part_file, url)
+
+def fetch_table(date):
+    """
+    Scrape the AFST table for 'YYYY-MM-DD' date from www.swift.psu.edu
+    """
  
     url = f'https://www.swift.psu.edu/operations/obsSchedule.php?d={date}&a=1'
     print(url)
@@ -86,21 +113,98 @@ def get_table(date):
     tab['TargetName'].mask[arr_bool] = True
 
     return  tab 
+
+_store = None
+
+def get_store():
+
+    global _store
+    if _store is None:
+        _store = schedule_store(conf['schedule_db'], fetch_table, conf.get('schedule_refresh_days', 3),
+            conf.get('schedule_refetch_minutes', 60))
+    return _store
+
+def get_table(date):
+    """
+    AFST table for 'YYYY-MM-DD' date, from the local schedule store if schedule_db is set
+    """
+
+    if not conf.get('schedule_db'):
+        return fetch_table(date)
+    return get_store().get_table(date)
     
+class obs_index:
+    """
+    Sorted interval index of the AFST table Begin/End columns for time -> obsid lookup
+    """
+
+    def __init__(self, tab):
+
+        arr_begin = np.array(list(tab['Begin']), dtype='datetime64[us]')
+        arr_end = np.array(list(tab['End']), dtype='datetime64[us]')
+
+        self._idx = np.argsort(arr_begin, kind='stable')
+        self._begin = arr_begin[self._idx].astype(np.int64)
+        # running max of End, the first row reaching tt is the first one that can contain it
+        self._end_max = np.maximum.accumulate(arr_end[self._idx].astype(np.int64)) if len(tab) else np.zeros(0, np.int64)
+
+        self._target_id = np.array(list(tab['TargetID']))[self._idx]
+        self._seg = np.array(list(tab['Seg.']))[self._idx]
+
+    def __len__(self):
+        return self._begin.size
+
+    def query(self, arr_tt):
+        """
+        Returns indexes (in the sorted table) of the first row containing each tt
+        and of the following row, -1 if there is none
+        """
+
+        arr_tt = np.atleast_1d(np.asarray(arr_tt, dtype='datetime64[us]')).astype(np.int64)
+
+        n = len(self)
+        arr_i = np.searchsorted(self._end_max, arr_tt, side='left')
+        arr_i_safe = np.minimum(arr_i, max(n - 1, 0))
+
+        arr_good = (arr_i < n)
+        if n:
+            arr_good &= (self._begin[arr_i_safe] <= arr_tt)
+
+        arr_i = np.where(arr_good, arr_i, -1)
+        arr_i_next = np.where(arr_good & (arr_i + 1 < n), arr_i + 1, -1)
+
+        return arr_i, arr_i_next
+
+    def get_target_seg(self, i):
+        if i < 0:
+            return None, None
+        return str(self._target_id[i]), str(self._seg[i])
+
+    def get_obsid(self, i):
+        if i < 0:
+            return None
+        return "{0:08d}{1:03d}".format(int(self._target_id[i]), int(self._seg[i]))
+
 def get_obs_id(tt, tab):
     """
-    Returns 'Target ID' and 'Seg.' for the tt time and the following ones
+    Returns 'Target ID' and 'Seg.' for the tt time and the following ones,
+    Nones if tt is not covered by the table
     """
 
-    for i in range(len(tab)):
+    index = obs_index(tab)
+    arr_i, arr_i_next = index.query(tt)
 
-        t1 = datetime.strptime(tab['Begin'][i], '%Y-%m-%d %H:%M:%S')
-        t2 = datetime.strptime(tab['End'][i], '%Y-%m-%d %H:%M:%S')
-        if tt >= t1 and tt <= t2:
-            if i < len(tab) - 2:
-                return tab['TargetID'][i], tab['Seg.'][i], tab['TargetID'][i+1], tab['Seg.'][i+1]
-            else:
-                return tab['TargetID'][i], tab['Seg.'][i], None, None
+    return (*index.get_target_seg(arr_i[0]), *index.get_target_seg(arr_i_next[0]))
+
+def get_obs_ids(arr_tt, tab):
+    """
+    Returns lists of obsid and next obsid for the array of times, None where there is no one
+    """
+
+    index = obs_index(tab)
+    arr_i, arr_i_next = index.query(arr_tt)
+
+    return [index.get_obsid(i) for i in arr_i], [index.get_obsid(i) for i in arr_i_next]
 
 def get_pointing_from_auxil(target_id, seq, tt, path):
 
@@ -123,7 +227,7 @@ def get_pointing_from_auxil(target_id, seq, tt, path):
         utcf = att[1].header['utcfinit']
         print(f'utcfinit={utcf} was found in {attfile}')
     else:
-        utcf = swiftbat.utcf(T0)
+        utcf = utcf_cache.utcf(T0)
         print(f'Use utcfinit={utcf} form caldb')
 
     print('utcf:', utcf)
@@ -137,9 +241,9 @@ def get_pointing_from_auxil(target_id, seq, tt, path):
 
 def write_pointing(t_utc, lst_point, file_name):
 
-    with open(file_name, 'w') as f:
-        f.write('Date               Time     R.A.     Dec.     Roll\n')
-        f.write("{:s} {:8.3f} {:8.3f} {:8.3f}\n".format(t_utc.strftime("%Y-%m-%d %H:%M:%S.%f"), lst_point[0], lst_point[1], lst_point[2]))
+    text_writer.write_columns(file_name, "%s %8.3f %8.3f %8.3f\n",
+        [t_utc.strftime("%Y-%m-%d %H:%M:%S.%f")], [lst_point[0]], [lst_point[1]], [lst_point[2]],
+        header='Date               Time     R.A.     Dec.     Roll\n')
 
 def test_get_pointing():
     """
@@ -181,6 +285,8 @@ def get_pointing(date_time, path_fits, path_to):
 
     target_id, seq, _, _ = get_obs_id(tt, tab)
     print(target_id, seq)
+    if target_id is None:
+        raise ValueError(f'No AFST entry for {date_time}')
 
     t_utc, lst_ra_dec_roll = get_pointing_from_auxil(target_id, seq, tt, path_fits)
 
@@ -201,6 +307,8 @@ def get_obsid(date_time):
     tab.write(out_file_name, overwrite=True, format='ascii.fixed_width', delimiter='', fill_values=[(ascii.masked, '--')])
     
     target_id, seq, target_id_next, seq_next  = get_obs_id(tt, tab)
+    if target_id is None:
+        raise ValueError(f'No AFST entry for {date_time}')
 
     obsid = "{0:08d}{1:03d}".format(int(target_id), int(seq))
     
@@ -213,6 +321,28 @@ def get_obsid(date_time):
 
     return obsid, obsid_next
 
+def get_obsids(lst_date_time):
+    """
+    obsid and next obsid for many 'YYYY-MM-DDThh:mm:ss.sss' times,
+    one AFST table and one lookup per day
+    """
+
+    arr_tt = np.array(lst_date_time, dtype='datetime64[us]')
+    arr_date = arr_tt.astype('datetime64[D]')
+
+    lst_obsid = [None] * arr_tt.size
+    lst_obsid_next = [None] * arr_tt.size
+
+    for day in np.unique(arr_date):
+        arr_idx = np.flatnonzero(arr_date == day)
+        tab = get_table(str(day))
+        lst_day, lst_day_next = get_obs_ids(arr_tt[arr_idx], tab)
+        for k, i in enumerate(arr_idx):
+            lst_obsid[i] = lst_day[k]
+            lst_obsid_next[i] = lst_day_next[k]
+
+    return lst_obsid, lst_obsid_next
+
 if __name__ == '__main__':
 
     date_time = '2021-12-15T17:51:27.2'
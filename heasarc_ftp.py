@@ -0,0 +1,217 @@
+"""
+Pool of authenticated FTP_TLS sessions to HEASARC and
+asyncio engine to download files through the pool concurrently
+"""
+import os
+import asyncio
+import threading
+import queue
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+import ftplib
+from ftplib import FTP_TLS
+
+heasarc_server = 'heasarc.gsfc.nasa.gov'
+
+# errors after which the session is dropped and a new one is opened
+conn_errors = (ftplib.error_temp, ftplib.error_reply, EOFError, OSError)
+
+class ftp_pool:
+    """
+    Keeps up to `size` logged in FTP_TLS sessions (with prot_p) and reuses them
+    across directories. Sessions are opened on demand.
+    """
+
+    def __init__(self, server=heasarc_server, size=4, timeout=60):
+
+        self.server = server
+        self.size = size
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()
+        self._sem = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._n_open = 0
+        self._closed = False
+
+    def _connect(self):
+
+        print("Connecting to {:s}...".format(self.server))
+        ftp = FTP_TLS(self.server, timeout=self.timeout)
+        ftp.login()
+        ftp.prot_p()
+        ftp.home = ftp.pwd()
+        with self._lock:
+            self._n_open += 1
+        return ftp
+
+    def _discard(self, ftp):
+
+        try:
+            ftp.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._n_open -= 1
+
+    def acquire(self):
+
+        if self._closed:
+            raise RuntimeError("FTP pool is closed")
+
+        self._sem.acquire()
+        try:
+            while True:
+                try:
+                    ftp = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                try:
+                    ftp.voidcmd('NOOP')
+                    return ftp
+                except conn_errors:
+                    self._discard(ftp)
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def release(self, ftp, broken=False):
+
+        if broken or self._closed:
+            self._discard(ftp)
+        else:
+            self._idle.put(ftp)
+        self._sem.release()
+
+    def run(self, func, *args):
+        """
+        Call func(ftp, *args) with a session from the pool.
+        The call is repeated once with a fresh session if the connection was lost.
+        """
+
+        for attempt in range(2):
+            ftp = self.acquire()
+            try:
+                res = func(ftp, *args)
+            except ftplib.error_perm:
+                self.release(ftp)
+                raise
+            except conn_errors:
+                self.release(ftp, broken=True)
+                if attempt == 1:
+                    raise
+                continue
+            except BaseException:
+                self.release(ftp, broken=True)
+                raise
+            self.release(ftp)
+            return res
+
+    def cwd(self, ftp, ftp_dir):
+        ftp.cwd(posixpath.join(ftp.home, ftp_dir))
+
+    def nlst(self, ftp_dir, str_pattern):
+        """
+        Returns sorted list of files matching str_pattern in ftp_dir.
+        Raises ftplib.error_perm if ftp_dir does not exist.
+        """
+
+        def _nlst(ftp):
+            self.cwd(ftp, ftp_dir)
+            try:
+                return sorted(ftp.nlst(str_pattern))
+            except ftplib.error_temp:
+                print("No {:s} files in directory".format(str_pattern))
+                return []
+
+        return self.run(_nlst)
+
+    def retr(self, ftp_dir, file_name, local_file):
+        """
+        Download ftp_dir/file_name to local_file
+        """
+
+        def _retr(ftp):
+            self.cwd(ftp, ftp_dir)
+            try:
+                with open(local_file, 'wb') as f:
+                    ftp.retrbinary('RETR {:s}'.format(file_name), f.write)
+            except BaseException:
+                # do not leave a truncated file that looks like a downloaded one
+                if os.path.isfile(local_file):
+                    os.remove(local_file)
+                raise
+            return local_file
+
+        return self.run(_retr)
+
+    def close(self):
+
+        self._closed = True
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                pass
+            with self._lock:
+                self._n_open -= 1
+
+async def fetch_files_async(pool, lst_jobs, max_parallel=None):
+    """
+    Download (ftp_dir, file_name, local_file) jobs through the pool,
+    with at most max_parallel transfers at a time.
+    Returns list of local file names or exceptions, in the order of lst_jobs.
+    """
+
+    if max_parallel is None:
+        max_parallel = pool.size
+
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(max_parallel)
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+
+        async def _fetch(ftp_dir, file_name, local_file):
+            async with sem:
+                print(f"Downloading {file_name}")
+                return await loop.run_in_executor(executor, pool.retr, ftp_dir, file_name, local_file)
+
+        return await asyncio.gather(*[_fetch(*job) for job in lst_jobs], return_exceptions=True)
+
+def fetch_files(pool, lst_jobs, max_parallel=None):
+    """
+    Blocking wrapper of fetch_files_async. Raises the first download error
+    after all the other transfers are finished.
+    """
+
+    if len(lst_jobs) == 0:
+        return []
+
+    lst_res = asyncio.run(fetch_files_async(pool, lst_jobs, max_parallel))
+
+    for res in lst_res:
+        if isinstance(res, BaseException):
+            raise res
+
+    return lst_res
+
+_pool = None
+_pool_pid = None
+
+def get_pool(size=4, server=heasarc_server):
+    """
+    Returns the pool shared within the process (a new one after fork)
+    """
+
+    global _pool, _pool_pid
+
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ftp_pool(server=server, size=size)
+        _pool_pid = os.getpid()
+
+    return _pool
@@ -0,0 +1,58 @@
+"""
+Streaming HTTP download with resume of partial files by Range requests
+"""
+import os
+import time
+
+import requests
+
+def stream_download(url, file_name, proxies=None, chunk_size=1 << 20, timeout=60):
+    """
+    Download url to file_name in chunks of chunk_size bytes.
+    If file_name exists it is treated as a partial download and only the rest is requested.
+    Returns number of bytes received. Raises IOError if the transfer is incomplete,
+    the partial file is kept to be resumed.
+    """
+
+    pos = os.path.getsize(file_name) if os.path.isfile(file_name) else 0
+    headers = {'Range': 'bytes={:d}-'.format(pos)} if pos else {}
+
+    t_start = time.time()
+    n_bytes = 0
+
+    with requests.get(url, proxies=proxies, verify=False, stream=True, headers=headers, timeout=timeout) as r:
+
+        if pos and r.status_code == 416:
+            total = r.headers.get('Content-Range', '').split('/')[-1]
+            if total.isdigit() and int(total) == pos:
+                print("{:s} is already complete".format(file_name))
+                return 0
+            # the partial file is not a prefix of the remote one
+            print("Range request for {:s} was rejected, download from the start".format(url))
+            os.remove(file_name)
+            return stream_download(url, file_name, proxies, chunk_size, timeout)
+
+        r.raise_for_status()
+
+        if pos and r.status_code != 206:
+            print("Server ignored Range request for {:s}, download from the start".format(url))
+            pos = 0
+
+        expected = None
+        if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+            expected = int(r.headers['Content-Length'])
+
+        with open(file_name, 'ab' if pos else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                n_bytes += len(chunk)
+
+    dt = max(time.time() - t_start, 1e-6)
+    print("{:s}: {:.2f} MB in {:.1f} s, {:.2f} MB/s{:s}".format(
+        url.split('/')[-1], n_bytes / 1024**2, dt, n_bytes / 1024**2 / dt,
+        ", resumed at {:d} bytes".format(pos) if pos else ""))
+
+    if expected is not None and n_bytes != expected:
+        raise IOError("Incomplete download of {:s}: got {:d} of {:d} bytes".format(url, n_bytes, expected))
+
+    return n_bytes
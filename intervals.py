@@ -0,0 +1,217 @@
+"""
+Interval arithmetic on datetime64 arrays of begin and end times
+
+Overlapping or duplicated intervals (as AFST rows may be) are counted once:
+a time belongs to the first interval (by begin) containing it, as in
+get_swift_obs_info.obs_index. All operations are vectorized, times are
+handled as int64 microseconds, durations are returned in seconds.
+"""
+import numpy as np
+
+def to_datetime64(arr):
+    """
+    datetime64[us] array from datetime64 or ISO strings ('YYYY-MM-DD HH:MM:SS' or with 'T')
+    """
+    return np.array(list(arr) if not isinstance(arr, np.ndarray) else arr, dtype='datetime64[us]')
+
+def from_table(tab, begin='Begin', end='End'):
+    """
+    Begin and end arrays of the schedule table columns
+    """
+    return to_datetime64(tab[begin]), to_datetime64(tab[end])
+
+def _to_us(arr):
+    return np.atleast_1d(to_datetime64(arr)).astype(np.int64)
+
+def _to_dt64(arr_us):
+    return arr_us.astype('datetime64[us]')
+
+def get_own_parts(arr_begin, arr_end):
+    """
+    The part of each interval which is not covered by intervals beginning before it,
+    in the order of the input. Returns (begin, end), begin == end for fully covered intervals.
+    """
+
+    b, e = _to_us(arr_begin), _to_us(arr_end)
+    e = np.maximum(e, b)
+
+    idx = np.argsort(b, kind='stable')
+    e_sorted = e[idx]
+
+    # running max of the ends of all previous intervals
+    e_prev = np.empty_like(e_sorted)
+    if e_sorted.size:
+        e_prev[0] = np.iinfo(np.int64).min
+        e_prev[1:] = np.maximum.accumulate(e_sorted)[:-1]
+
+    b_own = np.empty_like(b)
+    b_own[idx] = np.minimum(np.maximum(b[idx], e_prev), e_sorted)
+
+    return _to_dt64(b_own), _to_dt64(e)
+
+def get_own_durations(arr_begin, arr_end):
+    """
+    Durations (s) of the intervals with overlaps counted for the first of them only
+    """
+
+    b_own, e = get_own_parts(arr_begin, arr_end)
+    return (e - b_own).astype(np.int64) * 1e-6
+
+def merge(arr_begin, arr_end):
+    """
+    Union of the intervals as sorted disjoint intervals (begin, end)
+    """
+
+    b, e = _to_us(arr_begin), _to_us(arr_end)
+    e = np.maximum(e, b)
+
+    idx = np.argsort(b, kind='stable')
+    b, e = b[idx], e[idx]
+
+    if b.size == 0:
+        return _to_dt64(b), _to_dt64(e)
+
+    e_max = np.maximum.accumulate(e)
+
+    # a new interval starts where begin is after all previous ends
+    arr_start = np.ones(b.size, dtype=bool)
+    arr_start[1:] = b[1:] > e_max[:-1]
+
+    i_start = np.flatnonzero(arr_start)
+    i_last = np.append(i_start[1:] - 1, b.size - 1)
+
+    return _to_dt64(b[i_start]), _to_dt64(e_max[i_last])
+
+def intersect(arr_begin_1, arr_end_1, arr_begin_2, arr_end_2):
+    """
+    Intersection of two sets of intervals (e.g. schedule and GTIs) as sorted disjoint intervals
+    """
+
+    b1, e1 = merge(arr_begin_1, arr_end_1)
+    b2, e2 = merge(arr_begin_2, arr_end_2)
+
+    arr_t = np.concatenate((b1, e1, b2, e2)).astype(np.int64)
+    arr_step = np.concatenate((np.ones(b1.size), -np.ones(e1.size), np.ones(b2.size), -np.ones(e2.size))).astype(np.int64)
+
+    # ends go before begins at the same time, touching intervals do not intersect
+    idx = np.lexsort((arr_step, arr_t))
+    arr_t, arr_step = arr_t[idx], arr_step[idx]
+
+    arr_cover = np.cumsum(arr_step)
+    i_begin = np.flatnonzero(arr_cover == 2)
+
+    return _to_dt64(arr_t[i_begin]), _to_dt64(arr_t[i_begin + 1])
+
+def covered_before(arr_begin, arr_end, arr_t):
+    """
+    Total time (s) of the union of the intervals before each of arr_t
+    """
+
+    b, e = merge(arr_begin, arr_end)
+    b, e = b.astype(np.int64), e.astype(np.int64)
+    t = _to_us(arr_t)
+
+    arr_cum = np.concatenate(([0], np.cumsum(e - b)))
+
+    k = np.searchsorted(b, t, side='right') - 1
+    k_safe = np.maximum(k, 0)
+    arr_in = np.clip(t - b[k_safe], 0, e[k_safe] - b[k_safe]) if b.size else np.zeros_like(t)
+
+    return np.where(k >= 0, arr_cum[k_safe] + arr_in, 0) * 1e-6
+
+def total(arr_begin, arr_end, gti=None):
+    """
+    Total time (s) of the union of the intervals, only within gti = (begin, end) intervals if given
+    """
+
+    if gti is not None:
+        arr_begin, arr_end = intersect(arr_begin, arr_end, *gti)
+
+    b, e = merge(arr_begin, arr_end)
+    return float(np.sum((e - b).astype(np.int64))) * 1e-6
+
+def weighted_total(arr_begin, arr_end, arr_w, gti=None):
+    """
+    Sum of interval weights (e.g. coded fraction) times their durations (s),
+    with overlaps counted for the first interval only, only within gti = (begin, end) intervals if given.
+    arr_w may be (n_intervals,) or (n_sources, n_intervals).
+    """
+
+    b_own, e = get_own_parts(arr_begin, arr_end)
+
+    if gti is None:
+        arr_dt = (e - b_own).astype(np.int64) * 1e-6
+    else:
+        arr_dt = covered_before(*gti, e) - covered_before(*gti, b_own)
+
+    return np.asarray(arr_w, dtype=float) @ arr_dt
+
+def contains(arr_begin, arr_end, arr_t):
+    """
+    True for times of arr_t (e.g. trigger times) inside any of the intervals (begin <= t < end)
+    """
+
+    b, e = merge(arr_begin, arr_end)
+    t = _to_us(arr_t)
+
+    k = np.searchsorted(b.astype(np.int64), t, side='right') - 1
+    k_safe = np.maximum(k, 0)
+
+    if b.size == 0:
+        return np.zeros(t.size, dtype=bool)
+    return (k >= 0) & (t < e.astype(np.int64)[k_safe])
+
+def test_intervals(n_sets=200, seed=0):
+    """
+    Check the functions against brute-force coverage of random interval sets
+    on a grid of seconds, with overlapping, duplicated and empty intervals
+    """
+
+    rng = np.random.default_rng(seed)
+    t0 = np.datetime64('2020-01-01T00:00:00', 'us')
+    arr_sec = np.arange(1100)
+
+    def to_times(arr):
+        return t0 + arr.astype('timedelta64[s]')
+
+    def coverage(b, e):
+        return np.any((arr_sec[:,None] >= b) & (arr_sec[:,None] < e), axis=1)
+
+    for _ in range(n_sets):
+        n = rng.integers(0, 30)
+        b = rng.integers(0, 950, n)
+        e = b + rng.integers(0, 100, n)
+        b[rng.random(n) < 0.2] = b[0] if n else 0
+        w = rng.random(n)
+        gb = rng.integers(0, 950, 5)
+        ge = gb + rng.integers(0, 200, 5)
+
+        arr_cov = coverage(b, e)
+        arr_gti = coverage(gb, ge)
+
+        # the owner of each second is the first interval (by begin, stable) containing it
+        idx = np.argsort(b, kind='stable')
+        arr_in = (arr_sec[:,None] >= b[idx]) & (arr_sec[:,None] < e[idx])
+        arr_owner = np.where(arr_cov, idx[np.argmax(arr_in, axis=1)] if n else 0, -1)
+        w_sec = np.where(arr_owner >= 0, w[arr_owner] if n else 0.0, 0.0)
+
+        assert total(to_times(b), to_times(e)) == np.sum(arr_cov)
+        assert total(to_times(b), to_times(e), (to_times(gb), to_times(ge))) == np.sum(arr_cov & arr_gti)
+        assert np.isclose(weighted_total(to_times(b), to_times(e), w), np.sum(w_sec))
+        assert np.isclose(weighted_total(to_times(b), to_times(e), w, (to_times(gb), to_times(ge))), np.sum(w_sec[arr_gti]))
+        assert np.array_equal(get_own_durations(to_times(b), to_times(e)),
+            [np.sum(arr_owner == i) for i in range(n)])
+
+        mb, me = merge(to_times(b), to_times(e))
+        assert np.array_equal(coverage((mb - t0).astype(np.int64) // 10**6, (me - t0).astype(np.int64) // 10**6), arr_cov)
+        assert np.all(mb[1:] > me[:-1])
+
+        ib, ie = intersect(to_times(b), to_times(e), to_times(gb), to_times(ge))
+        assert np.array_equal(coverage((ib - t0).astype(np.int64) // 10**6, (ie - t0).astype(np.int64) // 10**6), arr_cov & arr_gti)
+
+        arr_t = rng.integers(-10, 1110, 50)
+        assert np.array_equal(contains(to_times(b), to_times(e), to_times(arr_t)), arr_cov[np.clip(arr_t, 0, arr_sec.size - 1)] & (arr_t >= 0) & (arr_t < arr_sec.size))
+        assert np.array_equal(covered_before(to_times(b), to_times(e), to_times(arr_t)),
+            [np.sum(arr_cov[:max(t, 0)]) for t in arr_t])
+
+    print("Interval functions match the brute-force coverage")
@@ -0,0 +1,96 @@
+"""
+Find the segment index of an obsid in https://swift.gsfc.nasa.gov/data/swift/.original/
+by concurrent HEAD requests. Found obsid -> segment pairs are kept in a json file.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import atomic_file
+from get_swift_obs_info import proxy
+
+orig_url = 'https://swift.gsfc.nasa.gov/data/swift/.original/sw{0:s}.{1:03d}/data/bat/rate/sw{0:s}{2:s}.lc.gz'
+
+n_segments = 25
+
+# obsid -> segment index
+dic_segment = {}
+
+def get_orig_url(obsid, idx, product='brtms'):
+    return orig_url.format(obsid, idx, product)
+
+def probe_url(url, timeout=30):
+    """
+    True if url exists, checked with HEAD request
+    """
+
+    try:
+        r = requests.head(url, proxies=proxy, verify=False, timeout=timeout, allow_redirects=True)
+    except requests.RequestException as e:
+        print(str(e))
+        return False
+
+    return r.status_code == 200
+
+def read_segments(file_name):
+
+    dic = atomic_file.read_json(file_name)
+    return dic if dic is not None else {}
+
+def write_segments(file_name, dic):
+    """
+    Write obsid -> segment dict to the json file
+    """
+
+    atomic_file.write_json(file_name, dic, indent=0, sort_keys=True)
+
+def find_segment(obsid, product='brtms', file_name=None, n_workers=8):
+    """
+    Returns the lowest segment index where the product of obsid exists, None if it is not found.
+    All candidate indexes are probed concurrently.
+    """
+
+    if obsid in dic_segment:
+        return dic_segment[obsid]
+
+    if file_name is not None:
+        dic_segment.update(read_segments(file_name))
+        if obsid in dic_segment:
+            return dic_segment[obsid]
+
+    lst_url = [get_orig_url(obsid, idx, product) for idx in range(n_segments)]
+
+    idx_found = None
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(probe_url, url) for url in lst_url]
+        # results are checked in index order, so the lowest existing index wins
+        for idx, fut in enumerate(futures):
+            if fut.result():
+                idx_found = idx
+                break
+        for fut in futures:
+            fut.cancel()
+
+    if idx_found is None:
+        print(f'No segment found for {obsid}')
+        return None
+
+    print(f'{idx_found} is good for {obsid}')
+    dic_segment[obsid] = idx_found
+    if file_name is not None:
+        dic = read_segments(file_name)
+        dic[obsid] = idx_found
+        write_segments(file_name, dic)
+
+    return idx_found
+
+def forget_segment(obsid, file_name=None):
+
+    dic_segment.pop(obsid, None)
+    if file_name is None or not os.path.isfile(file_name):
+        return
+
+    dic = read_segments(file_name)
+    if dic.pop(obsid, None) is not None:
+        write_segments(file_name, dic)
@@ -10,8 +10,13 @@ mpl.use('Agg')
 
 import sys
 import re
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import matplotlib.pyplot as pl 
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import  MultipleLocator #, FormatStrFormatter
 
 # шрифт
@@ -46,6 +51,17 @@ dic_x_ticks = {
 
 dic_x_minor_ticks = {1000:25, 64:5}
 
+def get_x_ticks(scale_ms, arr_begin_end):
+    """
+    Major ticks and minor tick step for the time axis
+    """
+
+    if scale_ms in dic_x_ticks:
+        return dic_x_ticks[scale_ms], dic_x_minor_ticks[scale_ms]
+
+    step = 10 if arr_begin_end[1] - arr_begin_end[0] <= 200 else 50
+    return np.arange(arr_begin_end[0], arr_begin_end[1] + step, step), step / 2
+
 # границы каналов
 arr_cuts = np.array([13.125, 50.0, 200.0, 750.0])
 arr_ELow = arr_cuts[0:4]
@@ -82,66 +98,177 @@ def get_delta_y(arr):
     return delta_y, y_min_, y_max_, y_max_int
 
 
-def plot_bat(
-    arr_ti, 
-    arr_rate,  
-    scale_ms, 
-    arr_begin_end, 
-    fig_file_name, 
-    caption=None
-    ):
-    
-    minorLocator_x = MultipleLocator(dic_x_minor_ticks[scale_ms])
-    
-    fig = pl.figure(figsize=(11.69, 8.27), edgecolor='w', facecolor='w')
-    ax = fig.add_axes(rect)
-    
-    str_label = "counts"
-    ax.set_ylabel(str_label, fontsize=label_font_size)
-    ax.set_xlabel(r'T-T$_{0}$ (s)',fontsize=label_font_size)
+# longer lightcurves in the plot window are drawn as min/max envelope of this many points
+max_points = 4000
 
-    ax.plot(arr_ti, arr_rate, drawstyle=step, color='k', linewidth=0.5)
-    
+def clip_lc(arr_ti, arr_rate, arr_begin_end):
+    """
+    Bins of the sorted lightcurve inside the plot window and one bin on each side of it
+    """
 
-    arr_bool = np.logical_and(arr_ti < arr_begin_end[1], arr_ti > arr_begin_end[0]) 
-    arr_bool_bg = np.logical_and(arr_ti< -10 , arr_ti > arr_begin_end[0]) 
+    i_1 = max(np.searchsorted(arr_ti, arr_begin_end[0], side='left') - 1, 0)
+    i_2 = np.searchsorted(arr_ti, arr_begin_end[1], side='right') + 1
+    return arr_ti[i_1:i_2], arr_rate[i_1:i_2]
 
-    arr_rate_cur = arr_rate[arr_bool]
+def decimate(arr_ti, arr_rate, n_max=max_points):
+    """
+    Min/max envelope of blocks of bins with at most about n_max points, peaks are kept
+    """
 
-    if arr_rate_cur.size == 0 or np.count_nonzero(arr_rate_cur) == 0:
-        print('No good data in the interval')
-        return
+    n = arr_ti.size
+    if n <= n_max:
+        return arr_ti, arr_rate
 
-    delta_y, y_min, y_max, y_max_int  = get_delta_y(arr_rate[arr_bool])
-    minorLocator_y_sum = MultipleLocator(delta_y/2.0)
- 
-    bg = np.mean(arr_rate[arr_bool_bg])
-    
+    k = int(np.ceil(2.0 * n / n_max))
+    idx = np.arange(0, n, k)
 
-    ax.axhline(bg, color='k', linestyle ='--', linewidth=0.5)
+    arr_t = np.empty(2 * idx.size, dtype=arr_ti.dtype)
+    arr_t[0::2] = arr_ti[idx]
+    arr_t[1::2] = arr_ti[np.minimum(idx + k // 2, n - 1)]
 
-    # рисуем временной интервал
-    #ax.vlines(arr_vlines, [y_min,y_min], [y_max,y_max], linestyles='dashed', color='k', linewidth=0.5)
+    arr_y = np.empty(2 * idx.size, dtype=np.result_type(arr_rate, np.float64))
+    arr_y[0::2] = np.minimum.reduceat(arr_rate, idx)
+    arr_y[1::2] = np.maximum.reduceat(arr_rate, idx)
 
-    ax.set_yticks(np.arange(y_min, y_max + delta_y, delta_y))
+    return arr_t, arr_y
 
-    ax.set_ylim(y_min, y_max_int)
-    
-    ax.tick_params(which='major', length=8, direction='in')
-    ax.tick_params(which='minor', length=4, direction='in')
-    
-    str_e_range = "%.0f - %.0f keV" % (25, 350)
-    pl.figtext(left_ch_names, bottom + 0.9 * width, str_e_range, ha='right', fontsize=12)
-     
-    #print(dic_x_ticks[scale_ms][0], dic_x_ticks[scale_ms][-1])
-    #ax.set_xlim(dic_x_ticks[scale_ms][0], dic_x_ticks[scale_ms][-1])
-    ax.set_xticks(dic_x_ticks[scale_ms])
-    ax.xaxis.set_minor_locator(minorLocator_x)
-    #ax.yaxis.set_minor_locator(minorLocator_y_sum)  # y minor ticks
-    ax.set_xlim(arr_begin_end[0], arr_begin_end[1])
-    
-    if(caption):
-        ax.set_title(caption, fontsize=18)   
+class bat_plotter:
+    """
+    One figure and its artists reused for many lightcurves,
+    only the data, limits, ticks and caption are updated between them
+    """
+
+    def __init__(self):
+
+        # without pyplot figures are not registered globally and are freed with the plotter
+        self.fig = Figure(figsize=(11.69, 8.27), edgecolor='w', facecolor='w')
+        FigureCanvasAgg(self.fig)
+
+        ax = self.fig.add_axes(rect)
+        self.ax = ax
+
+        str_label = "counts"
+        ax.set_ylabel(str_label, fontsize=label_font_size)
+        ax.set_xlabel(r'T-T$_{0}$ (s)',fontsize=label_font_size)
+
+        self.line, = ax.plot([], [], drawstyle=step, color='k', linewidth=0.5)
+        self.bg_line = ax.axhline(0.0, color='k', linestyle ='--', linewidth=0.5)
+
+        ax.tick_params(which='major', length=8, direction='in')
+        ax.tick_params(which='minor', length=4, direction='in')
+
+        str_e_range = "%.0f - %.0f keV" % (25, 350)
+        self.fig.text(left_ch_names, bottom + 0.9 * width, str_e_range, ha='right', fontsize=12)
 
-    #pl.savefig(fig_file_name, format='eps', dpi=1000)
-    pl.savefig(fig_file_name, format='png', dpi=100)
\ No newline at end of file
+    def plot(self, arr_ti, arr_rate, scale_ms, arr_begin_end, fig_file_name, caption=None):
+        """
+        Save the lightcurve plot to fig_file_name, returns False if there is no data to plot
+        """
+
+        ax = self.ax
+
+        arr_ti, arr_rate = clip_lc(arr_ti, arr_rate, arr_begin_end)
+
+        arr_bool = np.logical_and(arr_ti < arr_begin_end[1], arr_ti > arr_begin_end[0]) 
+        arr_bool_bg = np.logical_and(arr_ti< -10 , arr_ti > arr_begin_end[0]) 
+
+        arr_rate_cur = arr_rate[arr_bool]
+
+        if arr_rate_cur.size == 0 or np.count_nonzero(arr_rate_cur) == 0:
+            print('No good data in the interval')
+            return False
+
+        delta_y, y_min, y_max, y_max_int  = get_delta_y(arr_rate_cur)
+
+        bg = np.mean(arr_rate[arr_bool_bg])
+
+        self.line.set_data(*decimate(arr_ti, arr_rate))
+        self.bg_line.set_ydata([bg, bg])
+
+        ax.set_yticks(np.arange(y_min, y_max + delta_y, delta_y))
+        ax.set_ylim(y_min, y_max_int)
+
+        x_ticks, x_minor_step = get_x_ticks(scale_ms, arr_begin_end)
+        ax.set_xticks(x_ticks)
+        ax.xaxis.set_minor_locator(MultipleLocator(x_minor_step))
+        ax.set_xlim(arr_begin_end[0], arr_begin_end[1])
+
+        ax.set_title(caption if caption else '', fontsize=18)
+
+        #self.fig.savefig(fig_file_name, format='eps', dpi=1000)
+        self.fig.savefig(fig_file_name, format='png', dpi=100)
+        return True
+
+    def close(self):
+        self.fig.clear()
+
+_local = threading.local()
+
+def get_plotter():
+    """
+    Plotter of the current thread
+    """
+
+    if getattr(_local, 'plotter', None) is None:
+        _local.plotter = bat_plotter()
+    return _local.plotter
+
+def close_plotter():
+
+    if getattr(_local, 'plotter', None) is not None:
+        _local.plotter.close()
+        _local.plotter = None
+
+def plot_bat(
+    arr_ti, 
+    arr_rate,  
+    scale_ms, 
+    arr_begin_end, 
+    fig_file_name, 
+    caption=None
+    ):
+    """
+    Plot the lightcurve with the figure of the current thread reused
+    """
+
+    return get_plotter().plot(arr_ti, arr_rate, scale_ms, arr_begin_end, fig_file_name, caption)
+
+_executor = None
+_executor_pid = None
+_lst_futures = []
+
+def submit_plot(arr_ti, arr_rate, scale_ms, arr_begin_end, fig_file_name, caption=None, n_workers=0):
+    """
+    plot_bat in one of n_workers background threads, so that the caller goes on with data processing.
+    The plot is made here if n_workers is 0. wait_plots() waits for the submitted plots.
+    """
+
+    global _executor, _executor_pid
+
+    if n_workers <= 0:
+        return plot_bat(arr_ti, arr_rate, scale_ms, arr_begin_end, fig_file_name, caption)
+
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=n_workers)
+        _executor_pid = os.getpid()
+        _lst_futures.clear()
+
+    # only the window is passed, copied so the caller may reuse its arrays
+    arr_ti, arr_rate = (np.array(a) for a in clip_lc(arr_ti, arr_rate, arr_begin_end))
+    _lst_futures.append(_executor.submit(plot_bat, arr_ti, arr_rate, scale_ms, arr_begin_end, fig_file_name, caption))
+
+def wait_plots():
+    """
+    Wait for the plots submitted with submit_plot, raises the first plotting error
+    """
+
+    lst_futures = list(_lst_futures)
+    _lst_futures.clear()
+
+    err = None
+    for fut in lst_futures:
+        e = fut.exception()
+        if e is not None and err is None:
+            err = e
+    if err is not None:
+        raise err
@@ -0,0 +1,212 @@
+"""
+Local SQLite store of the Swift As-Flown Science Timeline (AFST) tables
+
+Each day is scraped once with get_swift_obs_info.fetch_table and kept on disk.
+Days closer than refresh_days to today are fetched again, since the AFST
+for them may still change, but not more often than every refetch_minutes.
+"""
+import os
+import json
+import sqlite3
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from astropy.table import Table, vstack
+
+def date_range(date_start, date_end):
+    """
+    List of 'YYYY-MM-DD' dates from date_start to date_end inclusive
+    """
+
+    tt_start = datetime.strptime(date_start, '%Y-%m-%d')
+    tt_end = datetime.strptime(date_end, '%Y-%m-%d')
+    return [(tt_start + timedelta(n)).strftime('%Y-%m-%d') for n in range((tt_end - tt_start).days + 1)]
+
+class schedule_store:
+
+    def __init__(self, db_file, fetch_table, refresh_days=3, refetch_minutes=60):
+        """
+        fetch_table(date) returns the AFST table for 'YYYY-MM-DD' date
+        """
+
+        self.db_file = db_file
+        self.fetch_table = fetch_table
+        self.refresh_days = refresh_days
+        self.refetch_minutes = refetch_minutes
+
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+
+        con = self._connect()
+        with con:
+            con.execute("""CREATE TABLE IF NOT EXISTS days
+                (date TEXT PRIMARY KEY, fetched TEXT, names TEXT)""")
+            con.execute("""CREATE TABLE IF NOT EXISTS rows
+                (date TEXT, idx INTEGER, begin TEXT, end TEXT, data TEXT, PRIMARY KEY (date, idx))""")
+            con.execute("CREATE INDEX IF NOT EXISTS rows_begin ON rows (begin)")
+            con.execute("CREATE INDEX IF NOT EXISTS rows_end ON rows (end)")
+        con.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def is_final(self, date, fetched):
+        """
+        The day is not fetched again if it was fetched refresh_days after its end
+        """
+
+        dt_fetched = datetime.strptime(fetched, '%Y-%m-%dT%H:%M:%S')
+        dt_final = datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1 + self.refresh_days)
+        return dt_fetched >= dt_final
+
+    def get_days(self):
+        """
+        Returns dict date -> fetched time of the stored days
+        """
+
+        con = self._connect()
+        dic = dict(con.execute("SELECT date, fetched FROM days").fetchall())
+        con.close()
+        return dic
+
+    def need_fetch(self, date, dic_days=None):
+
+        if dic_days is None:
+            dic_days = self.get_days()
+
+        if date not in dic_days:
+            return True
+        if self.is_final(date, dic_days[date]):
+            return False
+
+        # recent days are fetched again only after refetch_minutes
+        dt_fetched = datetime.strptime(dic_days[date], '%Y-%m-%dT%H:%M:%S')
+        dt_now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return dt_now - dt_fetched >= timedelta(minutes=self.refetch_minutes)
+
+    def put_table(self, date, tab):
+
+        names = tab.colnames
+        lst_rows = []
+        for i in range(len(tab)):
+            values = ['' if tab[c].mask[i] else str(tab[c][i]) for c in names] if tab.masked \
+                else [str(tab[c][i]) for c in names]
+            dic = dict(zip(names, values))
+            lst_rows.append((date, i, dic.get('Begin', ''), dic.get('End', ''), json.dumps(values)))
+
+        fetched = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+        con = self._connect()
+        with con:
+            con.execute("DELETE FROM rows WHERE date = ?", (date,))
+            con.executemany("INSERT INTO rows VALUES (?, ?, ?, ?, ?)", lst_rows)
+            con.execute("INSERT OR REPLACE INTO days VALUES (?, ?, ?)", (date, fetched, json.dumps(names)))
+        con.close()
+
+    def fetch(self, date):
+
+        tab = self.fetch_table(date)
+        self.put_table(date, tab)
+        return tab
+
+    def fetch_days(self, lst_dates, n_workers=1):
+        """
+        Fetch the days of lst_dates which need it with n_workers concurrent requests.
+        Each day is stored as soon as it is fetched, so an interrupted run continues from the stored days.
+        Returns list of (date, error) for the days that failed.
+        """
+
+        dic_days = self.get_days()
+        lst_fetch = [date for date in lst_dates if self.need_fetch(date, dic_days)]
+
+        def _fetch(date):
+            try:
+                self.fetch(date)
+            except Exception as e:
+                traceback.print_exc()
+                return "{:s}: {:s}".format(type(e).__name__, str(e))
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+            lst_err = list(executor.map(_fetch, lst_fetch))
+
+        return [(date, err) for date, err in zip(lst_fetch, lst_err) if err is not None]
+
+    def _make_table(self, names, lst_values):
+
+        tab = Table(rows=lst_values, names=names, masked=True)
+        if 'TargetName' in names and len(tab):
+            arr_bool = tab['TargetName'] == ''
+            tab['TargetName'].mask[arr_bool] = True
+        return tab
+
+    def read_table(self, date):
+        """
+        Returns the stored table for the date, None if the day was not stored
+        """
+
+        con = self._connect()
+        row = con.execute("SELECT names FROM days WHERE date = ?", (date,)).fetchone()
+        if row is None:
+            con.close()
+            return None
+        names = json.loads(row[0])
+        lst_values = [json.loads(r[0]) for r in
+            con.execute("SELECT data FROM rows WHERE date = ? ORDER BY idx", (date,))]
+        con.close()
+
+        return self._make_table(names, lst_values)
+
+    def get_table(self, date):
+        """
+        AFST table for 'YYYY-MM-DD' date, as get_swift_obs_info.fetch_table returns
+        """
+
+        if self.need_fetch(date):
+            return self.fetch(date)
+        return self.read_table(date)
+
+    def get_range(self, date_start, date_end, begin=None, end=None, n_workers=1, fetch=True):
+        """
+        AFST rows for days from date_start to date_end (inclusive) in one table.
+        Days that are not stored yet are fetched with n_workers concurrent requests if fetch is True.
+        begin, end ('YYYY-MM-DD HH:MM:SS') select rows overlapping with the time interval.
+        """
+
+        if fetch:
+            lst_failed = self.fetch_days(date_range(date_start, date_end), n_workers)
+            if lst_failed:
+                raise RuntimeError("Cannot fetch AFST for {:s}".format(', '.join(d for d, _ in lst_failed)))
+
+        query = "SELECT d.names, r.data FROM rows r JOIN days d ON r.date = d.date WHERE r.date >= ? AND r.date <= ?"
+        args = [date_start, date_end]
+        if begin is not None:
+            query += " AND r.end >= ?"
+            args.append(begin)
+        if end is not None:
+            query += " AND r.begin <= ?"
+            args.append(end)
+        query += " ORDER BY r.date, r.idx"
+
+        con = self._connect()
+        lst_rows = con.execute(query, args).fetchall()
+        con.close()
+
+        # AFST column names are expected to be the same for all days,
+        # tables with different names are stacked by astropy
+        lst_tab = []
+        names, lst_values = None, []
+        for names_json, data in lst_rows:
+            if names_json != names:
+                if lst_values:
+                    lst_tab.append(self._make_table(json.loads(names), lst_values))
+                names, lst_values = names_json, []
+            lst_values.append(json.loads(data))
+        if lst_values:
+            lst_tab.append(self._make_table(json.loads(names), lst_values))
+
+        if len(lst_tab) == 0:
+            return Table(masked=True)
+        if len(lst_tab) == 1:
+            return lst_tab[0]
+        return vstack(lst_tab)
@@ -62,7 +62,6 @@
 
 """
 
-import logging as log
 import datetime
 import os
 import re
@@ -72,23 +71,21 @@ import numpy as np
 import astropy.io.fits as fits
 from astropy.time import Time
 
-import swiftbat
-
 import clock
 import plot_swift_bat
+import text_writer
+import utcf_cache
 
-class swift_bat_lc:
-
-    def __init__(self, lc_file, T0_utc, res):
-        
-        lc = fits.open(lc_file)
+# native bin size (s) of the rate products
+dic_res_bin = {'ms': 0.064, '1s': 1.0}
 
-        self._time = lc['RATE'].data['TIME']
-        self._rate = lc['RATE'].data['COUNTS']
+class swift_bat_lc:
 
-        if res == 'ms':
-            self._rate = np.sum(self._rate[:,1:], axis=1)
-        
+    def __init__(self, lc_file, T0_utc, res, window=None):
+        """
+        window: (Ti, Tf) in seconds relative to T0, only rows inside it are read.
+        The whole lightcurve is read if window is None.
+        """
 
         self.time_utc = clock.parsetime(T0_utc)
         self.time_utc_sod = (self.time_utc - self.time_utc.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
@@ -98,46 +95,127 @@ class swift_bat_lc:
         #print("T0_met: ", type(T0_met))
         #exit()
 
-        MJDREFI = lc['PRIMARY'].header['MJDREFI']
-        MJDREFF = lc['PRIMARY'].header['MJDREFF']
-        UTCFINIT = lc['PRIMARY'].header['UTCFINIT']
+        # memmap works for uncompressed files, .gz files are decompressed by astropy
+        with fits.open(lc_file, memmap=True) as lc:
+            header = lc['PRIMARY'].header
+            data = lc['RATE'].data
+
+            MJDREFI = header['MJDREFI']
+            MJDREFF = header['MJDREFF']
+            UTCFINIT = header['UTCFINIT']
 
-        self._start_events = lc['PRIMARY'].header['TSTART']
-        self._stop_events = lc['PRIMARY'].header['TSTOP']
+            self._start_events = header['TSTART']
+            self._stop_events = header['TSTOP']
 
-        swiftref  = clock.parsetime("Jan 01 2001 00:00:00 UTC")      
+            swiftref  = clock.parsetime("Jan 01 2001 00:00:00 UTC")      
 
-        print("MJDREFI+MJDREFF:", clock.mjd2utc(MJDREFI+MJDREFF))
+            print("MJDREFI+MJDREFF:", clock.mjd2utc(MJDREFI+MJDREFF))
 
-        #log.info("MJDREFI swiftref: {:8.3f} {:8.3f}".format(MJDREFI, clock.utc2mjd(swiftref)))
-        if MJDREFI != clock.utc2mjd(swiftref):
-            log.error("MJDREFI != utc2mjd(swiftref): {:8.3f} {:8.3f}".format(MJDREFI, clock.utc2mjd(swiftref)))
-            exit(0)
+            #log.info("MJDREFI swiftref: {:8.3f} {:8.3f}".format(MJDREFI, clock.utc2mjd(swiftref)))
+            if MJDREFI != clock.utc2mjd(swiftref):
+                raise ValueError("MJDREFI != utc2mjd(swiftref): {:8.3f} {:8.3f}".format(MJDREFI, clock.utc2mjd(swiftref)))
 
-        if not lc['PRIMARY'].header['CLOCKAPP']:
-            print('CLOCKAPP is F')
-            UTCFINIT_T0 = swiftbat.utcf(T0_met)
-            print('UTCF for lc start: {:.5f}\nUTCF for T0: {:.5f}'.format(UTCFINIT, UTCFINIT_T0))
-            print('Use UTCF for T0!')
-            self._time = self._time + UTCFINIT_T0
+            utcf = 0.0
+            if not header['CLOCKAPP']:
+                print('CLOCKAPP is F')
+                UTCFINIT_T0 = utcf_cache.utcf(T0_met)
+                print('UTCF for lc start: {:.5f}\nUTCF for T0: {:.5f}'.format(UTCFINIT, UTCFINIT_T0))
+                print('Use UTCF for T0!')
+                utcf = UTCFINIT_T0
 
+            arr_time = data['TIME']
+            n_rows = arr_time.size
 
-        self._utc_start = lc['PRIMARY'].header['DATE-OBS']
-        self._utc_stop = lc['PRIMARY'].header['DATE-END']
+            # lightcurve bounds of the whole file
+            self._time_first = arr_time[0] + utcf if n_rows else np.nan
+            self._time_last = arr_time[-1] + utcf if n_rows else np.nan
 
-        self._telescope = lc['PRIMARY'].header['TELESCOP']
-        self._object = lc['PRIMARY'].header['OBJECT']
-        self._ra = lc['PRIMARY'].header['RA_OBJ']
-        self._dec = lc['PRIMARY'].header['DEC_OBJ']
+            if window is None:
+                i_1, i_2 = 0, n_rows
+            else:
+                # TIME is sorted, only the rows inside the window are decoded
+                i_1 = np.searchsorted(arr_time, T0_met - utcf + window[0], side='left')
+                i_2 = np.searchsorted(arr_time, T0_met - utcf + window[1], side='right')
+
+            rows = data[i_1:i_2]
+            self._time = np.array(rows['TIME'], dtype=np.float64) + utcf
+            self._rate = np.array(rows['COUNTS'])
+
+            if res == 'ms':
+                self._rate = np.sum(self._rate[:,1:], axis=1)
+
+            self._bin_size = lc['RATE'].header.get('TIMEDEL', dic_res_bin.get(res))
+            # rebinned lightcurves by rebin factor
+            self._dic_rebin = {1: (self._time, self._rate)}
+
+            self._utc_start = header['DATE-OBS']
+            self._utc_stop = header['DATE-END']
+
+            self._telescope = header['TELESCOP']
+            self._object = header['OBJECT']
+            self._ra = header['RA_OBJ']
+            self._dec = header['DEC_OBJ']
 
     def _swift2utc(self, met, swiftref, UTCFINIT):
         return swiftref + datetime.timedelta(seconds=(met + UTCFINIT))
 
-    def get_lc(self):
-        return self._time - self._trigger_time, self._rate
+    def get_lc(self, factor=1):
+        """
+        Lightcurve (T-T0, counts) with bins of factor native bins
+        """
+        arr_time, arr_rate = self.rebin(factor)
+        return arr_time - self._trigger_time, arr_rate
+
+    def get_bin_size(self, factor=1):
+        return self._bin_size * factor
+
+    def get_res_ms(self, factor=1):
+        return int(round(self._bin_size * factor * 1000))
+
+    def rebin(self, factor):
+        """
+        Returns (time, counts) summed over factor native bins, results are cached.
+        One of the bin edges is the native bin nearest to T0.
+        Bins not fully covered by the data (gaps and the ends) are dropped.
+        """
+
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError(f'Wrong rebin factor {factor}')
+
+        if factor in self._dic_rebin:
+            return self._dic_rebin[factor]
+
+        dt = self._bin_size
+        width = dt * factor
+
+        if self._time.size == 0:
+            self._dic_rebin[factor] = self._time, self._rate
+            return self._dic_rebin[factor]
+
+        t_ref = self._time[np.argmin(np.abs(self._time - self._trigger_time))]
+
+        # edges within half of the native bin from the data begin and end
+        k_1 = np.ceil((self._time[0] - t_ref) / width - 0.5 / factor)
+        k_2 = np.floor((self._time[-1] + dt - t_ref) / width + 0.5 / factor)
+        arr_edges = t_ref + width * np.arange(k_1, k_2 + 1)
+
+        arr_idx = np.searchsorted(self._time, arr_edges - 0.5 * dt)
+
+        arr_cum = np.cumsum(self._rate, axis=0)
+        arr_cum = np.concatenate((np.zeros((1,) + arr_cum.shape[1:], dtype=arr_cum.dtype), arr_cum))
+
+        arr_sum = arr_cum[arr_idx[1:]] - arr_cum[arr_idx[:-1]]
+        arr_good = (arr_idx[1:] - arr_idx[:-1]) == factor
+
+        self._dic_rebin[factor] = arr_edges[:-1][arr_good], arr_sum[arr_good]
+        return self._dic_rebin[factor]
 
     def get_ti_tf(self):
-        return self._time[0] - self._trigger_time, self._time[-1] - self._trigger_time
+        """
+        Begin and end of the lightcurve in the file relative to T0, also when only a window was read
+        """
+        return self._time_first - self._trigger_time, self._time_last - self._trigger_time
 
     def get_ipn_name(self):
         return self.time_utc.strftime('%Y%m%d_T') + "{:05d}".format(int(self.time_utc_sod))
@@ -145,33 +223,30 @@ class swift_bat_lc:
     def get_date_time(self):
         return self.time_utc.strftime('%Y-%m-%d %H:%M:%S.%f')
         
-    def write_ascii(self, path):
+    def write_ascii(self, path, factor=1):
 
         Ti, Tf = -1000.0, 5000.0
         Tf_bg = -20.0
 
-        arr_t = self._time - self._trigger_time
+        arr_t, rate = self.get_lc(factor)
         arr_bool = np.logical_and(arr_t >= Ti, arr_t <= Tf)
 
         arr_t = arr_t[arr_bool]
-        rate = self._rate[arr_bool]
+        rate = rate[arr_bool]
 
         bg = np.mean(rate[arr_t<=Tf_bg])
         if np.isnan(bg):
             bg = 0.0
-        header = self.ipn_header(bg)
+        header = self.ipn_header(bg, self.get_bin_size(factor))
 
-        with open(path,'w') as f:
-            f.write(header)
-            for i in range(arr_t.size):
-                f.write("{:8.3f} {:8.1f}\n".format(arr_t[i], rate[i]))
+        text_writer.write_columns(path, "%8.3f %8.1f\n", arr_t, rate, header=header)
 
-    def write_ascii_cnts(self, path):
-        self.write_ascii(path)
+    def write_ascii_cnts(self, path, factor=1):
+        self.write_ascii(path, factor)
 
-    def ipn_header(self, bg):
-        return "'SWIFT-BAT ' '{:s}'    {:8.3f}\n2.5000E+01 3.5000E+02\n {:.3f}    0.064\n".format(
-        self.time_utc.strftime('%d/%m/%y'), self.time_utc_sod, bg)
+    def ipn_header(self, bg, bin_size=0.064):
+        return "'SWIFT-BAT ' '{:s}'    {:8.3f}\n2.5000E+01 3.5000E+02\n {:.3f}    {:.3f}\n".format(
+        self.time_utc.strftime('%d/%m/%y'), self.time_utc_sod, bg, bin_size)
 
 if __name__ == '__main__':
 
@@ -1,49 +1,145 @@
 """
 Get BAT coding fraction history for given ra, dec
 """
+import os
 import ftplib
-from ftplib import FTP, FTP_TLS
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
 
 from astropy.table import Table, Column, vstack
 from astropy.io import ascii
 
-from get_swift_obs_info import get_table
-from get_coded_fov import code_ra_dec
+import atomic_file
+import heasarc_ftp
+import intervals
+from get_swift_obs_info import get_table, get_store
+from schedule_store import date_range
+from get_coded_fov import coded_frac
+
+import config
+
+conf = config.read_config('config.yaml')
 
-def get_full_table():
+def get_full_table(date_start, date_end, out_file_name=None, n_workers=conf.get('schedule_workers', 4)):
+    """
+    Harvest AFST tables for days from date_start to date_end ('YYYY-MM-DD', inclusive)
+    with n_workers concurrent requests and write them to one file.
+    With schedule_db set the days are kept in the schedule store as they arrive,
+    so an interrupted harvest continues from the stored days.
+    Returns list of (date, error) for the days that failed.
+    """
 
-    date_start = '2006-11-30'
-    #date_start = '2007-03-30'
+    if out_file_name is None:
+        out_file_name = 'tab_obs_{:s}_{:s}.txt'.format(date_start.replace('-',''), date_end.replace('-',''))
 
-    date_end   = '2007-04-01'
+    lst_dates = date_range(date_start, date_end)
 
-    out_file_name = 'tab_obs_{:s}_{:s}.txt'.format(date_start.replace('-',''), date_end.replace('-',''))
+    if conf.get('schedule_db'):
+        store = get_store()
+        lst_failed = store.fetch_days(lst_dates, n_workers)
+        tab = store.get_range(date_start, date_end, fetch=False)
+    else:
+        def _fetch(date):
+            try:
+                return get_table(date), None
+            except Exception as e:
+                return None, "{:s}: {:s}".format(type(e).__name__, str(e))
 
-    tt_start = datetime.strptime(date_start, '%Y-%m-%d')
-    tt_end   = datetime.strptime(date_end, '%Y-%m-%d')
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            lst_res = list(executor.map(_fetch, lst_dates))
 
-    delta = tt_end - tt_start + timedelta(1)
+        lst_failed = [(date, err) for date, (_, err) in zip(lst_dates, lst_res) if err is not None]
+        lst_tab = [t for t, _ in lst_res if t is not None and len(t)]
+        tab = vstack(lst_tab) if lst_tab else Table(masked=True)
 
-    tab = Table(masked=True)
+    print("Harvested {:d} days, {:d} rows, {:d} days failed".format(len(lst_dates), len(tab), len(lst_failed)))
+    for date, err in lst_failed:
+        print("  {:s}: {:s}".format(date, err))
 
-    for tt in (tt_start + timedelta(n) for n in range(delta.days)):
-        date = tt.strftime("%Y-%m-%d")
-        tab = vstack([tab, get_table(date)])
+    if len(tab) == 0:
+        return lst_failed
 
     tab['TargetName'][:] = [s.replace(' ','') for s in tab['TargetName']]
     tab['Begin'][:] = [s.replace(' ','T') for s in tab['Begin']]
     tab['End'][:] = [s.replace(' ','T') for s in tab['End']]
     tab.write(out_file_name, overwrite=True, format='ascii.fixed_width', delimiter='', fill_values=[(ascii.masked, '--')])
+
+    return lst_failed
         
 def get_exposure(tab):
+    """
+    Exposure (days) of the schedule table, overlapping rows are counted once
+    """
+
+    return intervals.total(*intervals.from_table(tab)) / timedelta(days=1).total_seconds()
+
+def get_pointings(tab):
+    """
+    Arrays of R.A., Dec., Roll of the schedule table rows, NaN for rows without pointing
+    """
+
+    return tuple(np.ma.filled(np.ma.asarray(tab[c], dtype=float), np.nan) for c in ['R.A.', 'Dec.', 'Roll'])
+
+def get_coding_frac_matrix(arr_ra, arr_dec, tab, chunk_size=256):
+    """
+    (N, M) coded fraction matrix of N sources arr_ra, arr_dec (deg) for M schedule table rows.
+    Sources are processed by chunk_size to limit the memory of intermediate arrays.
+    """
+
+    arr_ra = np.atleast_1d(np.asarray(arr_ra, dtype=float))
+    arr_dec = np.atleast_1d(np.asarray(arr_dec, dtype=float))
+    arr_p_ra, arr_p_dec, arr_p_roll = get_pointings(tab)
+
+    arr_cf = np.empty((arr_ra.size, arr_p_ra.size))
+    for i in range(0, arr_ra.size, chunk_size):
+        sl = slice(i, i + chunk_size)
+        arr_cf[sl] = coded_frac(arr_ra[sl,None], arr_dec[sl,None], arr_p_ra, arr_p_dec, arr_p_roll)
+
+    return np.nan_to_num(arr_cf, nan=0.0)
+
+def get_src_exposure(arr_ra, arr_dec, tab, code_frac=0.5):
+    """
+    Returns (N, M) coded fraction matrix and exposure (days) of each of N sources
+    with the coded fraction above code_frac in M schedule table rows
+    """
+
+    arr_cf = get_coding_frac_matrix(arr_ra, arr_dec, tab)
+    arr_exp_days = intervals.weighted_total(*intervals.from_table(tab), arr_cf > code_frac) / timedelta(days=1).total_seconds()
+
+    return arr_cf, arr_exp_days
+
+def get_cf_exposure(arr_cf, tab, gti=None):
+    """
+    Exposure (days) weighted by the coded fraction arr_cf, (M,) or (N, M) for M schedule table rows,
+    within gti = (begin, end) datetime64 arrays if given
+    """
+
+    return intervals.weighted_total(*intervals.from_table(tab), arr_cf, gti) / timedelta(days=1).total_seconds()
+
+def test_get_exposure():
+    """
+    Exposure of schedule rows which overlap, are duplicated or empty, as AFST rows may be
+    """
+
+    tab = Table({'Begin': ['2021-01-01T00:00:00', '2021-01-01T00:30:00', '2021-01-01T00:30:00', '2021-01-01T02:00:00', '2021-01-01T03:00:00'],
+        'End': ['2021-01-01T01:00:00', '2021-01-01T01:30:00', '2021-01-01T01:30:00', '2021-01-01T02:00:00', '2021-01-01T04:00:00']})
+    hour = 1.0 / 24
+
+    # union of the rows: 00:00-01:30 and 03:00-04:00
+    assert np.isclose(get_exposure(tab), 2.5 * hour)
+
+    # overlaps are weighted by the first row: 0.5 x 1 h + 1.0 x 0.5 h (duplicate row adds nothing) + 0.2 x 1 h
+    arr_cf = np.array([0.5, 1.0, 1.0, 1.0, 0.2])
+    assert np.isclose(get_cf_exposure(arr_cf, tab), 1.2 * hour)
+    assert np.allclose(get_cf_exposure(np.array([arr_cf, np.ones(5)]), tab), [1.2 * hour, 2.5 * hour])
 
-    t_exp_days = 0
-    for i in range(len(tab)):
-        dt = datetime.strptime(tab['End'][i], '%Y-%m-%dT%H:%M:%S') - datetime.strptime(tab['Begin'][i], '%Y-%m-%dT%H:%M:%S')
-        t_exp_days += dt.total_seconds() / timedelta(days=1).total_seconds()
+    # within 00:45-03:30: 0.5 x 0.25 h + 1.0 x 0.5 h + 0.2 x 0.5 h
+    gti = (intervals.to_datetime64(['2021-01-01T00:45:00']), intervals.to_datetime64(['2021-01-01T03:30:00']))
+    assert np.isclose(get_cf_exposure(arr_cf, tab, gti), 0.725 * hour)
 
-    return t_exp_days
+    print('Exposure: {:.4f} days'.format(get_exposure(tab)))
 
 def get_add_coding_frac():
     """
@@ -59,17 +155,9 @@ def get_add_coding_frac():
 
     #tab = tab[50:200]
 
-    lst_code_frac = []
+    arr_code_frac = get_coding_frac_matrix(src_ra, src_dec, tab)[0]
 
-    for i in range(len(tab)):
-        p_ra, p_dec, p_roll = tab['R.A.'][i], tab['Dec.'][i], tab['Roll'][i]
-        s_0 = code_ra_dec(p_ra, p_dec, p_ra, p_dec, p_roll)
-        s_src = code_ra_dec(src_ra, src_dec, p_ra, p_dec, p_roll)
-
-        lst_code_frac.append(s_src/s_0)
-
-
-    col_code_frac = Column(data=lst_code_frac, name='BATCodeFrac')
+    col_code_frac = Column(data=arr_code_frac, name='BATCodeFrac')
     tab.add_column(col_code_frac)
 
     fmt = {'BATCodeFrac':'%.2f'}
@@ -81,11 +169,8 @@ def get_add_coding_frac():
     tab.write('tab_full_cf50.txt', overwrite=True, format='ascii.fixed_width', formats=fmt, delimiter='', fill_values=[(ascii.masked, '--')])
     print('Box center exposire: ', get_exposure(tab))
 
-    lst_evt = []    
-    for i in range(len(tab)):
-        obsid = "{0:08d}{1:03d}".format(int(tab['TargetID'][i]), int(tab['Seg.'][i]))
-        lst_ = check_event_data(tab['Begin'][i], obsid)
-        lst_evt.append(','.join(lst_))
+    lst_obsid = ["{0:08d}{1:03d}".format(int(tab['TargetID'][i]), int(tab['Seg.'][i])) for i in range(len(tab))]
+    lst_evt = [','.join(lst_) for lst_ in check_event_data_list(list(tab['Begin']), lst_obsid)]
 
     col_evt = Column(data=lst_evt, name='EvtData')
     tab.add_column(col_evt)
@@ -105,44 +190,94 @@ def get_date(date_time):
     lst = (date_time.split('T')[0]).split('-')
     return '{:s}{:s}{:s}'.format(lst[0], lst[1], lst[2])
 
-def nlst(ftp, str_pattern):
+def get_event_dir(date_time, obsid):
 
-    files = []
-    try:
-        files = sorted(ftp.nlst(str_pattern))
-    except ftplib.error_temp:
-        print("No {:s} files in directory".format(str_pattern))
-    return files
+    date = get_date(date_time)
+    return "swift/data/obs/{:s}_{:s}/{:s}/bat/event".format(date[0:4], date[4:6], obsid)
 
-def check_event_data(date_time, obsid):
+def read_listing(file_name, recheck_days=None):
+    """
+    Returns cached list of files, None if there is no cached listing.
+    An empty listing (data may still come to HEASARC) older than recheck_days is treated as missing.
+    """
 
-    date = get_date(date_time)
+    dic = atomic_file.read_json(file_name)
+    if not isinstance(dic, dict) or 'files' not in dic:
+        return None
 
-    server = 'heasarc.gsfc.nasa.gov'
-    ftp_dir = "swift/data/obs/{:s}_{:s}/{:s}/bat/event".format(date[0:4], date[4:6], obsid)
+    if len(dic['files']) == 0 and recheck_days is not None:
+        if 'listed' not in dic:
+            return None
+        dt_listed = datetime.strptime(dic['listed'], '%Y-%m-%dT%H:%M:%S')
+        if datetime.now(timezone.utc).replace(tzinfo=None) - dt_listed >= timedelta(days=recheck_days):
+            return None
 
-    print("Try to find {:s}...".format(ftp_dir))
-    ftp = FTP_TLS(server)
-    ftp.login()
-    ftp.prot_p()
+    return dic['files']
+
+def write_listing(file_name, ftp_dir, lst_files):
+    """
+    Write the listing of ftp_dir with the current UTC time to the json file
+    """
+
+    listed = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    atomic_file.write_json(file_name, {'ftp_dir': ftp_dir, 'files': lst_files, 'listed': listed}, indent=0)
+
+def check_event_data(date_time, obsid, pool=None, cache_dir=None):
+    """
+    Returns list of *evt* files in the BAT event directory of obsid, empty if there is no such directory.
+    The listing is kept in cache_dir/<obsid>_evt.json and is not requested again,
+    except empty ones after ftp_listing_recheck_days.
+    """
+
+    ftp_dir = get_event_dir(date_time, obsid)
 
+    file_name = None
+    if cache_dir is not None:
+        file_name = os.path.join(cache_dir, '{:s}_evt.json'.format(obsid))
+        all_files = read_listing(file_name, conf.get('ftp_listing_recheck_days', 7))
+        if all_files is not None:
+            return all_files
+
+    if pool is None:
+        pool = heasarc_ftp.get_pool(conf.get('ftp_pool_size', 4))
+
+    print("Try to find {:s}...".format(ftp_dir))
     try:
-        ftp.cwd(ftp_dir)
+        all_files = pool.nlst(ftp_dir, '*evt*')
         print("Found evt path: {:s}".format(ftp_dir))
-    
-        name = 'sw{:s}'.format(obsid)
-        all_files = nlst(ftp,'*evt*')
-        
-        ftp.quit()
-        #print("All done, disconnect")
-        return all_files
-
     except ftplib.error_perm:
         #print("The folder {:s} does not exist!".format(ftp_dir))
-        ftp.quit()
-        #print("Disconnect")
-        return []
+        all_files = []
+
+    if file_name is not None:
+        write_listing(file_name, ftp_dir, all_files)
+
+    return all_files
+
+def check_event_data_list(lst_date_time, lst_obsid, n_workers=None, cache_dir=None):
+    """
+    check_event_data for each date_time, obsid pair with n_workers concurrent requests
+    through the shared HEASARC session pool. Listings are cached in cache_dir
+    (ftp_listing_cache from config.yaml by default).
+    """
+
+    pool_size = conf.get('ftp_pool_size', 4)
+    if n_workers is None:
+        n_workers = pool_size
+
+    if cache_dir is None:
+        cache_dir = conf.get('ftp_listing_cache')
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    pool = heasarc_ftp.get_pool(pool_size)
+
+    def _check(args):
+        return check_event_data(*args, pool=pool, cache_dir=cache_dir)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_check, zip(lst_date_time, lst_obsid)))
 
 if __name__ == "__main__":
-    #get_full_table()
+    #get_full_table('2006-11-30', '2007-04-01')
     get_add_coding_frac()
\ No newline at end of file
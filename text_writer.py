@@ -0,0 +1,45 @@
+"""
+Bulk writer of column data to text files
+
+Rows are formatted with one %-format operation per chunk of rows
+and written with one call, instead of a format and a write call per row.
+"""
+from itertools import chain
+
+import numpy as np
+
+def _to_list(col):
+    # Python scalars format exactly as numpy scalars with '{:...}'.format
+    if isinstance(col, np.ndarray):
+        return col.tolist()
+    return list(col)
+
+def format_rows(fmt_row, *columns):
+    """
+    Returns rows of columns formatted with fmt_row, e.g. "%8.3f %8.1f\\n"
+    """
+
+    lst_cols = [_to_list(c) for c in columns]
+    n = len(lst_cols[0]) if lst_cols else 0
+    if n == 0:
+        return ''
+
+    return (fmt_row * n) % tuple(chain.from_iterable(zip(*lst_cols)))
+
+def write_rows(f, fmt_row, *columns, chunk_rows=200000):
+    """
+    Write rows of columns formatted with fmt_row to the open text file f
+    """
+
+    n = len(columns[0]) if columns else 0
+    for i in range(0, n, chunk_rows):
+        f.write(format_rows(fmt_row, *[c[i:i + chunk_rows] for c in columns]))
+
+def write_columns(file_name, fmt_row, *columns, header=''):
+    """
+    Write header and rows of columns formatted with fmt_row to file_name
+    """
+
+    with open(file_name, 'w') as f:
+        f.write(header)
+        write_rows(f, fmt_row, *columns)
@@ -0,0 +1,94 @@
+"""
+Swift UTCF (MET -> UTC correction) for arrays of MET
+
+The clock correction table of swiftbat is read once per process and
+kept in a compact npz file, so other processes and later runs do not
+read (or download) the clock file again. UTCF is evaluated with the
+table polynomials as swiftbat.utcf does it, for scalars or arrays.
+"""
+import os
+import time
+
+import numpy as np
+
+import atomic_file
+import config
+
+conf = config.read_config('config.yaml')
+
+# print a caveat if UTCF is more than 90 days stale, as swiftbat does
+caveat_time = 86400 * 90
+
+lst_columns = ['tstart', 'tstop', 'toffset', 'c0', 'c1', 'c2']
+
+_table = None
+
+def read_swiftbat_table():
+    """
+    Returns dict of the clock correction table columns of the swiftbat clock file
+    """
+
+    from astropy.io import fits
+    from swiftbat.clockinfo import clockErrData
+
+    clock_file = clockErrData().clockfile()
+    with fits.open(clock_file) as hdul:
+        dic = {c: np.array(hdul[1].data.field(c.upper()), dtype=np.float64) for c in lst_columns}
+    dic['clockfile'] = np.array(os.path.basename(clock_file))
+    return dic
+
+def load_table(file_name=None, max_age_days=30):
+    """
+    Clock correction table from the npz cache if it is younger than max_age_days,
+    otherwise from swiftbat (the cache is updated then)
+    """
+
+    if file_name is not None and os.path.isfile(file_name):
+        age = time.time() - os.path.getmtime(file_name)
+        if age < max_age_days * 86400:
+            with np.load(file_name) as data:
+                return {k: data[k] for k in data.files}
+
+    dic = read_swiftbat_table()
+
+    if file_name is not None:
+        try:
+            atomic_file.write_npz(file_name, **dic)
+        except OSError as e:
+            print("Cannot save the clock correction table to {:s}: {:s}".format(file_name, str(e)))
+
+    return dic
+
+def get_table():
+
+    global _table
+    if _table is None:
+        _table = load_table(conf.get('utcf_cache'), conf.get('utcf_cache_days', 30))
+    return _table
+
+def utcf(met):
+    """
+    Correction (s) to add to Swift MET to get UTC, for a scalar or an array of MET
+    """
+
+    tab = get_table()
+    arr_met = np.asarray(met, dtype=np.float64)
+
+    # last table row starting before met, the first one for earlier times
+    arr_row = np.searchsorted(tab['tstart'], arr_met, side='right') - 1
+    if np.any(arr_row < 0):
+        print("**** Time before first clock correction table entry")
+    arr_row = np.maximum(arr_row, 0)
+
+    arr_stale = tab['tstop'][arr_row] + caveat_time < arr_met
+    if np.any(arr_stale):
+        print("**** Time {:.1f} days after clock correction interval".format(
+            np.max((arr_met - tab['tstop'][arr_row])[arr_stale]) / 86400))
+
+    ddays = (arr_met - tab['tstart'][arr_row]) / 86400.0
+    tcorr = tab['toffset'][arr_row] + 1e-6 * (
+        tab['c0'][arr_row] + ddays * (tab['c1'][arr_row] + ddays * tab['c2'][arr_row]))
+
+    if np.ndim(met) == 0:
+        return float(-tcorr)
+    return -tcorr